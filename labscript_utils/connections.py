@@ -18,6 +18,10 @@ import labscript_utils.excepthook
 import numpy as np
 import copy
 import ast
+import hashlib
+import threading
+from collections import OrderedDict
+from types import MappingProxyType
 from labscript_utils.dict_diff import dict_diff
 import sys
 from zprocess import raise_exception_in_thread
@@ -27,10 +31,119 @@ def _ensure_str(s):
     return s.decode() if isinstance(s, bytes) else str(s)
 
 
+def _freeze(o):
+    """Return a read-only version of a deserialised dict, list or other object, with
+    dicts replaced with read-only mapping proxies and lists with tuples, recursively.
+    Note that tuples do not compare equal to lists with the same contents."""
+    if isinstance(o, dict):
+        return MappingProxyType({key: _freeze(value) for key, value in o.items()})
+    elif isinstance(o, list):
+        return tuple(_freeze(value) for value in o)
+    return o
+
+
+def _hash_raw(raw, *extra):
+    """Return a hash of the contents of a structured array, or of a row of one,
+    along with the repr() of any extra objects given"""
+    raw_hash = hashlib.blake2b(digest_size=16)
+    if raw.dtype.hasobject:
+        # Variable length strings. The raw bytes are pointers, so hash the values
+        # instead:
+        raw_hash.update(repr(raw.tolist()).encode('utf8'))
+    else:
+        raw_hash.update(repr(raw.dtype.descr).encode('utf8'))
+        raw_hash.update(raw.tobytes())
+    for obj in extra:
+        raw_hash.update(repr(obj).encode('utf8'))
+    return raw_hash.digest()
+
+
+class _NotDeserialised(object):
+    """Type of the sentinel for columns of a Connection that have not yet been
+    deserialised. Pickles and copies as a reference to the single module-level
+    instance, so that identity checks with it still work after a Connection is
+    pickled or copied."""
+
+    def __reduce__(self):
+        return '_NOT_DESERIALISED'
+
+    def __repr__(self):
+        return '_NOT_DESERIALISED'
+
+
+_NOT_DESERIALISED = _NotDeserialised()
+
+
+class ConnectionTableCache(object):
+    """A least-recently-used cache of parsed connection tables, keyed by a hash of
+    the contents of the connection table dataset and its master_pseudoclock
+    attribute. Consecutive shot files usually have identical connection tables, and
+    this allows them to be parsed only once. ConnectionTable(..., use_cache=True) uses
+    the process-wide instance of this class, connection_table_cache.
+
+    The cache holds at most maxsize tables. Counts of hits and misses are kept in the
+    hits and misses attributes."""
+
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._tables = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached table for the given key, or None if there is none"""
+        with self._lock:
+            try:
+                table = self._tables[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._tables.move_to_end(key)
+            self.hits += 1
+            return table
+
+    def put(self, key, table):
+        """Add a table to the cache, evicting the least recently used tables if the
+        cache is full"""
+        with self._lock:
+            self._tables[key] = table
+            self._tables.move_to_end(key)
+            while len(self._tables) > self.maxsize:
+                self._tables.popitem(last=False)
+
+    def clear(self):
+        """Empty the cache and reset the hit and miss counts"""
+        with self._lock:
+            self._tables.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """Return a dict of the hits, misses, maxsize and current size of the
+        cache"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'maxsize': self.maxsize,
+                'currsize': len(self._tables),
+            }
+
+
+connection_table_cache = ConnectionTableCache()
+
+
 class ConnectionTable(object):
-    def __init__(self, h5file, logging_prefix=None, exceptions_in_thread=False):
+    def __init__(
+        self, h5file, logging_prefix=None, exceptions_in_thread=False, use_cache=False
+    ):
         """Object to represent a connection table. Set logging prefix if you
-        desire logging. Log used will be <prefix>.ConnectionTable"""
+        desire logging. Log used will be <prefix>.ConnectionTable. If use_cache is
+        True, the parsed table will be shared with any previously parsed table with
+        identical contents held in connection_table_cache, instead of being parsed
+        again. The Connection objects of such tables are shared and should not be
+        modified."""
         self.filepath = h5file
         self.logger = None
         if logging_prefix is not None:
@@ -39,6 +152,15 @@ class ConnectionTable(object):
             
         self.toplevel_children = {}
         self.table = {}
+        # Indices for fast lookups, populated by self._build_tree():
+        self._children_by_port = {}
+        self._attached_devices = {}
+        self._reachable = {}
+        # Hash of the contents of the table, computed on demand by
+        # self._get_table_hash():
+        self._table_hash = None
+        # Created on demand by the self.columns property:
+        self._columns = None
         self.master_pseudoclock = None
         self.raw_table = np.empty(0)
 
@@ -62,12 +184,22 @@ class ConnectionTable(object):
                     pass
 
                 try:
+                    if use_cache:
+                        key = _hash_raw(self.raw_table, self.master_pseudoclock)
+                        cached_table = connection_table_cache.get(key)
+                        if cached_table is not None:
+                            if self.logger:
+                                self.logger.debug('Using cached connection table')
+                            self._copy_from(cached_table)
+                            return
                     all_connections = [Connection(raw_row) for raw_row in self.raw_table]
                     self.table = {connection.name: connection for connection in all_connections}
-                    for name, connection in self.table.items():
-                        connection._populate_relatives(self.table)
-                        if connection.parent_port is None:
-                            self.toplevel_children[name] = connection
+                    self._build_tree()
+                    if use_cache:
+                        # Cache a copy, since remove_device() may modify this one:
+                        cached_table = ConnectionTable.__new__(ConnectionTable)
+                        cached_table._copy_from(self)
+                        connection_table_cache.put(key, cached_table)
                 except Exception:
                     msg = 'Could not parse connection table in %s' % h5file
                     if self.logger: self.logger.error(msg)
@@ -84,12 +216,83 @@ class ConnectionTable(object):
             else:
                 raise
 
+    def _build_tree(self):
+        """Link each connection to its parent and children and populate the lookup
+        indices, in a single pass over the table"""
+        for name, connection in self.table.items():
+            parent = self.table.get(connection.parent_name)
+            if parent is not None:
+                parent.child_list[name] = connection
+                connection.parent = parent
+            if connection.parent_port is None:
+                self.toplevel_children[name] = connection
+            # Only the first match is kept, to be consistent with the order of a search
+            # through the table:
+            key = (connection.parent_name, connection.parent_port)
+            self._children_by_port.setdefault(key, connection)
+            if connection.BLACS_connection:
+                self._attached_devices[name] = connection.device_class
+        self._index_reachable()
+        # Hash the subtrees now so that comparisons with other tables can skip any
+        # subtrees that are identical:
+        for connection in self.toplevel_children.values():
+            connection._get_subtree_hash()
+
+    def _index_reachable(self):
+        """Index the connections that can be reached by walking down the child_list
+        of each top-level device. These are the connections find_by_name() finds,
+        which after remove_device() is not the same as those in self.table: a removed
+        device is still in its parent's child_list, and the descendants of a removed
+        top-level device are no longer reachable."""
+        self._reachable = {}
+        stack = list(self.toplevel_children.values())
+        while stack:
+            connection = stack.pop()
+            if connection.name not in self._reachable:
+                self._reachable[connection.name] = connection
+                stack.extend(connection.child_list.values())
+
+    def _copy_from(self, other):
+        """Share the parsed contents of another ConnectionTable, with our own copies
+        of the dicts that remove_device() modifies"""
+        self.raw_table = other.raw_table
+        self.master_pseudoclock = other.master_pseudoclock
+        self.table = other.table.copy()
+        self.toplevel_children = other.toplevel_children.copy()
+        self._children_by_port = other._children_by_port.copy()
+        self._attached_devices = other._attached_devices.copy()
+        self._reachable = other._reachable.copy()
+        self._table_hash = other._table_hash
+        self._columns = other._columns
+
+    def _get_table_hash(self):
+        """Return a hash of the contents of all rows in the table. If two tables have
+        the same hash, they have the same contents."""
+        if self._table_hash is None:
+            table_hash = hashlib.blake2b(digest_size=16)
+            for name in sorted(self.table):
+                table_hash.update(self.table[name]._get_row_hash())
+            self._table_hash = table_hash.digest()
+        return self._table_hash
+
+    @property
+    def columns(self):
+        """A ConnectionTableColumns for bulk queries on the raw table, created the
+        first time it is accessed"""
+        if self._columns is None:
+            self._columns = ConnectionTableColumns(self.raw_table)
+        return self._columns
+
     def assert_superset(self, other):
         # let's check that we're a superset of the connection table in "other"
         if not isinstance(other, ConnectionTable):
             msg = "Loaded file is not a valid connection table"
             raise TypeError(msg)
         
+        # If the tables are identical, there is nothing to check:
+        if self._get_table_hash() == other._get_table_hash():
+            return
+
         missing = []    # things I don't know exist
         incompat = []   # things that are different from what I expect
         
@@ -162,33 +365,17 @@ class ConnectionTable(object):
         connected to BLACS, based on whether their 'BLACS_connection'
         attribute is non-empty. Returns a dictionary of them in the form
         {device_instance_name: labscript_class_name}"""
-        attached_devices = {}
-        for name, device in self.table.items():
-            if device.BLACS_connection:
-                # The device is connected to BLACS. Save its name and class:
-                attached_devices[name] = device.device_class
-        return attached_devices
+        # Return a copy so calling code can't modify our index:
+        return self._attached_devices.copy()
         
     # Returns the "Connection" object which is a child of "parent_name",
     # connected via "parent_port" Eg, Returns the child of "pulseblaster_0"
     # connected via "dds 0"
     def find_child(self, parent_name, parent_port):
-        for name, connection in self.table.items():
-            if (connection.parent_name == parent_name 
-                    and connection.parent_port == parent_port):
-                return connection
-        return None
+        return self._children_by_port.get((parent_name, parent_port))
     
     def find_by_name(self,name):
-        name = _ensure_str(name)
-        for device_name, connection in self.toplevel_children.items():
-            if device_name == name:
-                return connection
-            else:
-                result = connection.find_by_name(name)
-                if result is not None:
-                    return result
-        return None
+        return self._reachable.get(_ensure_str(name))
 
     def remove_device(self, device_name):
         """Removes a device from the ConnectionTable, but keeps it in the
@@ -198,43 +385,174 @@ class ConnectionTable(object):
             del self.toplevel_children[device_name]
         if device_name == self.master_pseudoclock:
             self.master_pseudoclock = None
-        del self.table[device_name]
+        connection = self.table.pop(device_name)
+        key = (connection.parent_name, connection.parent_port)
+        if self._children_by_port.get(key) is connection:
+            del self._children_by_port[key]
+            # Fall back to the next match in the table, if any:
+            for other in self.table.values():
+                if (other.parent_name, other.parent_port) == key:
+                    self._children_by_port[key] = other
+                    break
+        self._attached_devices.pop(device_name, None)
+        self._table_hash = None
+        self._index_reachable()
+
+
+def _decode_column(column):
+    """Decode a column of bytestrings, numpy strings or variable length strings to
+    an array of python strings"""
+    if column.dtype.kind == 'S':
+        return np.char.decode(column, 'utf8')
+    elif column.dtype.kind == 'U':
+        return column
+    return np.array([_ensure_str(value) for value in column], dtype=str)
+
+
+class ConnectionTableColumns(object):
+    """Columnar view of the name, class, parent and parent port columns of a
+    connection table, each decoded once to an array of python strings. This allows
+    bulk queries such as finding all devices of a given class without constructing a
+    Connection for every row. Queries return boolean masks which can be used to index
+    the columns or the raw table, for example:
+
+        columns = ConnectionTableColumns.from_file(h5file)
+        columns.name[columns.devices_of_class('PulseBlaster')]
+
+    Unlike Connection.parent_port, the parent port of top-level devices is the string
+    'None', as stored in the table."""
+    COLUMNS = {
+        'name': 'name',
+        'class': 'device_class',
+        'parent': 'parent_name',
+        'parent port': 'parent_port',
+    }
+
+    def __init__(self, raw_table):
+        """raw_table may be the structured array of a connection table, or the
+        connection table h5py dataset itself"""
+        for column, attr in self.COLUMNS.items():
+            if raw_table.dtype.names is None:
+                # Empty table:
+                setattr(self, attr, np.empty(0, dtype=str))
+            else:
+                setattr(self, attr, _decode_column(raw_table[column]))
+
+    @classmethod
+    def from_file(cls, h5file):
+        """Read only the required columns of the connection table in the given HDF5
+        file and return a ConnectionTableColumns for them"""
+        with h5py.File(h5file, 'r') as hdf5_file:
+            # Indexing the dataset by column name reads only that column:
+            return cls(hdf5_file['connection table'])
+
+    def __len__(self):
+        return len(self.name)
+
+    def devices_of_class(self, device_class):
+        """Mask of the rows of devices of the given labscript class"""
+        return self.device_class == device_class
+
+    def children_of(self, parent_name):
+        """Mask of the rows of devices whose parent is the given device"""
+        return self.parent_name == parent_name
+
+    def toplevel(self):
+        """Mask of the rows of devices that have no parent port"""
+        return self.parent_port == 'None'
+
+    def find(self, name):
+        """Return the row index of the device with the given name, or None if there
+        is no such device"""
+        indices = np.flatnonzero(self.name == _ensure_str(name))
+        if len(indices):
+            return int(indices[0])
+        return None
 
 
 class Connection(object):
     """A class to represent a row in the connection table, present the
     contents as instance attributes after deserialising their contents, and
     providing default values for backward compatibility with older HDF5 files.
-    Contains links to Connection objects for child devices of each device"""
+    Contains links to Connection objects for child devices of each device.
+
+    The raw row is kept, and the 'properties' and 'unit conversion params' columns
+    are only deserialised the first time they are accessed, since most users of a
+    connection table only need the names and relationships of devices."""
+    # Slots for the attributes we set ourselves, and a __dict__ so that other code may
+    # still set attributes of its own:
+    __slots__ = (
+        '_raw_row',
+        'name',
+        'device_class',
+        'parent_name',
+        'parent_port',
+        'unit_conversion_class',
+        'BLACS_connection',
+        '_unit_conversion_params',
+        '_properties',
+        '_unit_conversion_params_view',
+        '_properties_view',
+        '_row_hash',
+        '_subtree_hash',
+        'child_list',
+        'parent',
+        '__dict__',
+        '__weakref__',
+    )
+
     _defaults = {'unit conversion class': None,
                 'unit conversion params': {},
                 'BLACS_connection': "",
                 'properties': {}}
 
     def __init__(self, raw_row):
+        self._raw_row = raw_row
 
-        # Populate a dict with the defaults:
-        self._rowdict = self._defaults.copy()
+        # Populate attributes:
+        self.name = self._get_item('name')
+        self.device_class = self._get_item('class')
+        self.parent_name = self._get_item('parent')
+        self.parent_port = self._get_item('parent port')
+        self.unit_conversion_class = self._get_item('unit conversion class')
+        self.BLACS_connection = self._get_item('BLACS_connection')
 
-        # Put the given values in, overwriting the defaults if applicable:
-        deserialised_items = {_ensure_str(name): self._deserialise(name, value)
-                              for name, value in zip(raw_row.dtype.names, raw_row)}
+        # Deserialised on first access:
+        self._unit_conversion_params = _NOT_DESERIALISED
+        self._properties = _NOT_DESERIALISED
+        self._unit_conversion_params_view = None
+        self._properties_view = None
 
-        self._rowdict.update(deserialised_items)
-            
-        # Populate attributes:
-        self.name = self._rowdict['name']
-        self.device_class = self._rowdict['class']
-        self.parent_name = self._rowdict['parent']
-        self.parent_port = self._rowdict['parent port']
-        self.unit_conversion_class = self._rowdict['unit conversion class']
-        self._unit_conversion_params = self._rowdict['unit conversion params']
-        self.BLACS_connection = self._rowdict['BLACS_connection']
-        self._properties = self._rowdict['properties']
+        # Computed on demand by self._get_row_hash() and self._get_subtree_hash():
+        self._row_hash = None
+        self._subtree_hash = None
         
-        # To be populated by self._populate_relatives:
+        # To be populated by ConnectionTable._build_tree():
         self.child_list = {}
         self.parent = None
+
+    def _get_item(self, name):
+        """Return the deserialised value of the given column of the row, or its
+        default value if the row does not have that column"""
+        if name in self._raw_row.dtype.fields:
+            return self._deserialise(name, self._raw_row[name])
+        # Copy so that the defaults are not shared between instances:
+        return copy.deepcopy(self._defaults[name])
+
+    @property
+    def _rowdict(self):
+        """The contents of the row as a dict, deserialised and with defaults for any
+        missing columns"""
+        rowdict = self._defaults.copy()
+        for name in self._raw_row.dtype.names:
+            name = _ensure_str(name)
+            if name == 'unit conversion params':
+                rowdict[name] = self._get_unit_conversion_params()
+            elif name == 'properties':
+                rowdict[name] = self._get_properties()
+            else:
+                rowdict[name] = self._deserialise(name, self._raw_row[name])
+        return rowdict
         
     def _deserialise(self, name, value):
         """deserialise one item of the row depending on what it is"""
@@ -256,30 +574,94 @@ class Connection(object):
                 return ast.literal_eval(_ensure_str(value))
         return _ensure_str(value)
 
-    def _populate_relatives(self, table):
-        """Populate child devices based on a list of other connection objects,
-        and set self.parent to our parent device."""
-        for name, connection in table.items():
-            if connection.parent_name == self.name:
-                self.child_list[connection.name] = connection
-            if name == self.parent_name:
-                self.parent = connection
+    def _get_unit_conversion_params(self):
+        """Return our unit conversion params, deserialising them if this has not
+        already been done. The returned object must not be modified."""
+        if self._unit_conversion_params is _NOT_DESERIALISED:
+            self._unit_conversion_params = self._get_item('unit conversion params')
+        return self._unit_conversion_params
+
+    def _get_properties(self):
+        """Return our properties, deserialising them if this has not already been
+        done. The returned object must not be modified."""
+        if self._properties is _NOT_DESERIALISED:
+            self._properties = self._get_item('properties')
+        return self._properties
+
+    def _get_row_hash(self):
+        """Return a hash of the raw contents of the row. Rows with equal hashes have
+        equal contents. Rows with different hashes may still have equal contents once
+        deserialised, for example if they were stored with different string widths."""
+        if self._row_hash is None:
+            self._row_hash = _hash_raw(self._raw_row)
+        return self._row_hash
+
+    def _get_subtree_hash(self):
+        """Return a hash of this row and, recursively, the rows of all our children.
+        Connections with equal subtree hashes have identical contents all the way
+        down."""
+        if self._subtree_hash is None:
+            subtree_hash = hashlib.blake2b(self._get_row_hash(), digest_size=16)
+            for name in sorted(self.child_list):
+                subtree_hash.update(name.encode('utf8'))
+                subtree_hash.update(self.child_list[name]._get_subtree_hash())
+            self._subtree_hash = subtree_hash.digest()
+        return self._subtree_hash
+
+    def __getstate__(self):
+        # The read-only views are mapping proxies, which cannot be pickled. Leave them
+        # out, they are recreated on demand:
+        excluded = ('__dict__', '__weakref__')
+        excluded += ('_unit_conversion_params_view', '_properties_view')
+        slots = {name: getattr(self, name) for name in self.__slots__}
+        return self.__dict__, {k: v for k, v in slots.items() if k not in excluded}
+
+    def __setstate__(self, state):
+        instance_dict, slots = state
+        self.__dict__.update(instance_dict)
+        for name, value in slots.items():
+            setattr(self, name, value)
+        self._unit_conversion_params_view = None
+        self._properties_view = None
 
     def __eq__(self, other):
+        if self._get_row_hash() == other._get_row_hash():
+            return True
         return self._rowdict == other._rowdict
 
     def __ne__(self, other):
-        return self._rowdict != other._rowdict
+        return not self == other
 
     @property
     def unit_conversion_params(self):
         # Return a copy so calling code can't modify our instance attribute
-        return copy.deepcopy(self._unit_conversion_params)
+        return copy.deepcopy(self._get_unit_conversion_params())
         
     @property
     def properties(self):
         # Return a copy so calling code can't modify our instance attribute
-        return copy.deepcopy(self._properties)
+        return copy.deepcopy(self._get_properties())
+
+    @property
+    def unit_conversion_params_view(self):
+        """A read-only view of the unit conversion params, for callers that do not
+        need a copy they can modify. Nested dicts are read-only mappings and lists are
+        tuples, so a list in the view does not compare equal to the same list in
+        unit_conversion_params. The view is created once and then reused."""
+        if self._unit_conversion_params_view is None:
+            params = self._get_unit_conversion_params()
+            self._unit_conversion_params_view = _freeze(params)
+        return self._unit_conversion_params_view
+
+    @property
+    def properties_view(self):
+        """A read-only view of the properties, for callers that do not need a copy
+        they can modify. Nested dicts are read-only mappings and lists are tuples, so
+        a list in the view does not compare equal to the same list in properties. The
+        view is created once and then reused."""
+        if self._properties_view is None:
+            self._properties_view = _freeze(self._get_properties())
+        return self._properties_view
         
     def diff(self, other):
         return dict_diff(self._rowdict, other._rowdict)
@@ -287,6 +669,10 @@ class Connection(object):
     def compare_to(self, other_connection):
         if not isinstance(other_connection,Connection):
             return False,{"error":"Internal Error. Connection Table object is corrupted."}
+
+        # If the whole subtree is identical, there is nothing to check:
+        if self._get_subtree_hash() == other_connection._get_subtree_hash():
+            return True, {}
             
         error = {}
         # Compare all parameters between this connection, and other connection
@@ -298,11 +684,14 @@ class Connection(object):
             error["parent_port"] = True
         if self.unit_conversion_class != other_connection.unit_conversion_class:
             error["unit_conversion_class"] = True
-        if self.unit_conversion_params != other_connection.unit_conversion_params:
+        if (
+            self._get_unit_conversion_params()
+            != other_connection._get_unit_conversion_params()
+        ):
             error["unit_conversion_params"] = True
         if self.BLACS_connection != other_connection.BLACS_connection:
             error["BLACS_connection"] = True
-        if self.properties != other_connection.properties:
+        if self._get_properties() != other_connection._get_properties():
             error["properties"] = True
         
         # for each child in other_connection, check that the child also exists here
@@ -12,8 +12,27 @@
 #####################################################################
 import sys
 import os
+import threading
+import atexit
+import logging
+import traceback
+import asyncio
+import hashlib
+import shutil
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect_right
+from time import monotonic, sleep, time
 
-from labscript_utils.ls_zprocess import Lock, connect_to_zlock_server, kill_lock
+import zmq
+
+from labscript_utils.ls_zprocess import (
+    get_config,
+    Lock,
+    AsyncLock,
+    kill_lock,
+)
 from labscript_utils import dedent
 from labscript_utils.shared_drive import path_to_agnostic
 
@@ -36,35 +55,818 @@ if 'h5py' in sys.modules:
         
 import h5py
 
+logger = logging.getLogger('labscript_utils.h5_lock')
+
+# Lock leases. If enabled, a process keeps its zlock lock on a file for a grace period
+# after closing it, so that reopening it soon after does not require communicating
+# with the zlock server. Nested opens of a file within a thread share a single lease.
+_lease_grace_period = None
+# Leases held by this process, by zlock key:
+_leases = {}
+# Protects _leases and notifies the thread releasing leases after their grace period:
+_leases_condition = threading.Condition()
+_lease_releaser_thread = None
+# The zlock server releases locks held for longer than their timeout. Leases are not
+# reused once older than this fraction of it, and are refreshed instead if in use:
+LEASE_MAX_AGE_FRACTION = 0.25
+
+
+class _Lease(object):
+    """A zlock lock held by this process on behalf of one or more open files"""
+    def __init__(self, key, read_only, timeout=None):
+        self.key = key
+        self.read_only = read_only
+        self.timeout = timeout
+        kwargs = {'read_only': True} if read_only else {}
+        self.lock = Lock(key, **kwargs)
+        # Thread that acquired the lock. Only it can refresh the lock, so only it may
+        # reuse the lease:
+        self.thread = threading.get_ident()
+        # Number of open files using the lease:
+        self.refcount = 0
+        # Time at which to release an unused lease:
+        self.expiry = None
+        # Whether the lease is in _leases, such that it may be reused:
+        self.registered = False
+        self.acquired_time = None
+        self.max_age = None
+        # The zlock server's timeout on the lock, or None for the fcntl backend:
+        self.server_timeout = None
+        # Number of times the lock has been acquired, see refresh():
+        self.holds = 0
+
+    def acquire(self):
+        # Before the request, so that it precedes the start of the server's timeout:
+        start = monotonic()
+        self.lock.acquire(timeout=self.timeout)
+        self.acquired_time = start
+        self.holds = 1
+        # The fcntl backend has no client and its locks do not time out:
+        client = getattr(self.lock, 'client', None)
+        if client is not None:
+            timeout = self.timeout
+            if timeout is None:
+                timeout = client.default_timeout
+            self.server_timeout = float(timeout)
+            self.max_age = LEASE_MAX_AGE_FRACTION * self.server_timeout
+
+    def refresh(self):
+        """Restart the zlock server's timeout on the lock, by acquiring it again
+        reentrantly. If the lock was certainly still held, the reentrant acquisition is
+        then released. Otherwise the server may have already released the lock, making
+        this a new acquisition that must not be released yet, so it is kept until
+        release(). Must be called from the thread that acquired the lock whilst it is
+        in use."""
+        start = monotonic()
+        self.lock.acquire(timeout=self.timeout)
+        if monotonic() - self.acquired_time < 0.5 * self.server_timeout:
+            self.lock.release()
+        else:
+            self.holds += 1
+        self.acquired_time = start
+
+    def release(self):
+        """Release the lock as many times as it was acquired. If the server released
+        the lock before it was refreshed, the final release fails, and is ignored"""
+        holds, self.holds = self.holds, 0
+        for i in range(holds):
+            try:
+                self.lock.release()
+            except zmq.ZMQError:
+                if i == 0:
+                    raise
+                break
+
+    def is_old(self):
+        if self.max_age is None:
+            return False
+        return monotonic() - self.acquired_time > self.max_age
+
+
+def _release_lock_of_lease(lease):
+    """Release the lock of a lease that is no longer in use, logging rather than
+    raising any exception, such as the zlock server having already released it"""
+    try:
+        lease.release()
+    except Exception:
+        logger.exception('Failed to release lock lease on %s', lease.key)
+
+
+def _acquire_lease(key, read_only, timeout=None, register=False):
+    """Return a lease on the given key, reusing an existing one if it was acquired by
+    the current thread and is not read-only when a write lock is required. Unused
+    leases too old to reuse, or acquired by other threads, are released. Otherwise
+    acquire a new lock from the zlock server, with the given timeout. The new lease is
+    registered for reuse if leases are enabled, or if register is True."""
+    thread = threading.get_ident()
+    stale_lease = None
+    with _leases_condition:
+        lease = _leases.get(key)
+        if lease is not None:
+            reusable = lease.thread == thread and (read_only or not lease.read_only)
+            if reusable and not (lease.refcount == 0 and lease.is_old()):
+                lease.refcount += 1
+                lease.expiry = None
+            elif lease.refcount == 0:
+                # Unused, but we cannot or should not reuse it. Release it:
+                del _leases[key]
+                lease.registered = False
+                stale_lease = lease
+                lease = None
+            else:
+                lease = None
+    if lease is not None:
+        if lease.is_old():
+            try:
+                lease.refresh()
+            except:
+                _release_lease(lease)
+                raise
+        return lease
+    if stale_lease is not None:
+        _release_lock_of_lease(stale_lease)
+    lease = _Lease(key, read_only, timeout)
+    lease.acquire()
+    lease.refcount = 1
+    with _leases_condition:
+        # Another thread may have registered a lease on this key in the meantime, in
+        # which case ours will not be shared and will be released upon close:
+        if (_lease_grace_period is not None or register) and key not in _leases:
+            _leases[key] = lease
+            lease.registered = True
+    return lease
+
+
+def _release_lease(lease):
+    """Decrement the reference count of a lease, and if it is no longer used, either
+    schedule it for release after the grace period, or release it now. Leases are not
+    kept past their maximum age."""
+    with _leases_condition:
+        lease.refcount -= 1
+        if lease.refcount > 0:
+            return
+        if lease.registered and _lease_grace_period is not None:
+            lease.expiry = monotonic() + _lease_grace_period
+            if lease.max_age is not None:
+                lease.expiry = min(lease.expiry, lease.acquired_time + lease.max_age)
+            _start_lease_releaser()
+            _leases_condition.notify()
+            return
+        if lease.registered:
+            del _leases[lease.key]
+            lease.registered = False
+    _release_lock_of_lease(lease)
+
+
+def _release_expired_leases(release_all=False):
+    """Release all unused leases whose grace period has expired, or all unused leases
+    if release_all is True. Return the time until the next expiry, or None if there
+    are no unused leases remaining."""
+    expired = []
+    next_expiry = None
+    with _leases_condition:
+        now = monotonic()
+        for key, lease in list(_leases.items()):
+            if lease.refcount > 0 or lease.expiry is None:
+                continue
+            if release_all or lease.expiry <= now:
+                del _leases[key]
+                lease.registered = False
+                expired.append(lease)
+            elif next_expiry is None or lease.expiry < next_expiry:
+                next_expiry = lease.expiry
+    for lease in expired:
+        _release_lock_of_lease(lease)
+    if next_expiry is not None:
+        return max(next_expiry - monotonic(), 0)
+    return None
+
+
+def _lease_releaser():
+    while True:
+        try:
+            timeout = _release_expired_leases()
+        except Exception:
+            logger.exception('Error releasing expired lock leases')
+            timeout = 1
+        with _leases_condition:
+            _leases_condition.wait(timeout)
+
+
+def _start_lease_releaser():
+    # Must be called with _leases_condition held
+    global _lease_releaser_thread
+    if _lease_releaser_thread is None or not _lease_releaser_thread.is_alive():
+        _lease_releaser_thread = threading.Thread(
+            target=_lease_releaser, name='h5_lock lease releaser', daemon=True
+        )
+        _lease_releaser_thread.start()
+
+
+def enable_lock_leases(grace_period=1.0):
+    """Keep zlock locks on files for grace_period seconds after they are closed, and
+    reuse them if the file is reopened by the same thread in the meantime, avoiding
+    communication with the zlock server. Nested opens of a file within the same thread
+    share a single lock, such that only the first open and the final release
+    communicate with the zlock server. Note that other processes must wait up to the
+    grace period longer to open a file this process has closed.
+
+    So that the zlock server does not release a lock whilst it is still in use, and so
+    that a file reopened repeatedly does not keep other processes waiting
+    indefinitely, a lock is not reused once older than LEASE_MAX_AGE_FRACTION of the
+    zlock timeout. Instead it is released and acquired again, or, if the file is still
+    open, its timeout is restarted."""
+    global _lease_grace_period
+    _lease_grace_period = grace_period
+
+
+def disable_lock_leases():
+    """Stop keeping zlock locks on files after they are closed, and release any that
+    are currently being kept"""
+    global _lease_grace_period
+    _lease_grace_period = None
+    _release_expired_leases(release_all=True)
+
+
+atexit.register(_release_expired_leases, release_all=True)
+
+
+class _LeasedLock(object):
+    """Object with the same acquire() and release() methods as a zlock Lock, that
+    uses a lease instead of acquiring and releasing the lock directly"""
+    def __init__(self, key, read_only=False):
+        self.key = key
+        self.read_only = read_only
+        self._lease = None
+
+    def acquire(self):
+        self._lease = _acquire_lease(self.key, self.read_only)
+
+    def release(self):
+        _release_lease(self._lease)
+        self._lease = None
+
+
+class LockBatch(object):
+    """Locks on many files, acquired together up front, such that File objects can
+    then be opened on them by the same thread without communicating with the zlock
+    server. For example, to process all shots in a sequence:
+
+        with LockBatch(paths) as batch:
+            for path in paths:
+                with batch.open(path) as f:
+                    ...
+
+    Locks are acquired in a sorted order, such that two processes acquiring
+    overlapping batches cannot deadlock. If acquiring any lock fails, those already
+    acquired are released. The timeout is the time in seconds the zlock server
+    allows the locks to be held for, defaulting to the usual default for h5_lock,
+    and should be long enough to process the whole batch. Files opened after the
+    server may have released their locks are locked again.
+
+    If read_only is True (the default), the files can only be opened in mode 'r'
+    without additional locking. Opening them for writing instead requires read_only
+    to be False."""
+    def __init__(self, paths, read_only=True, timeout=None):
+        self.keys = sorted(set(path_to_agnostic(path) for path in paths))
+        self.read_only = read_only
+        self.timeout = timeout
+        self._leases = []
+
+    def acquire(self):
+        try:
+            for key in self.keys:
+                lease = _acquire_lease(
+                    key, self.read_only, timeout=self.timeout, register=True
+                )
+                self._leases.append(lease)
+        except:
+            self.release()
+            raise
+
+    def release(self):
+        while self._leases:
+            _release_lease(self._leases.pop())
+
+    def open(self, path, mode=None, **kwargs):
+        """Open one of the files, in mode 'r' if the batch is read-only or 'r+'
+        otherwise, unless another mode is given. Other arguments are passed to
+        File()."""
+        if mode is None:
+            mode = 'r' if self.read_only else 'r+'
+        return File(path, mode, **kwargs)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+# Lock statistics. If enabled, the time each open of a file waited to acquire its zlock
+# lock, and how long the lock was then held, are recorded in histograms per file.
+_lock_stats_enabled = False
+# Histograms of wait and hold times, by zlock key:
+_lock_stats = {}
+_lock_stats_lock = threading.Lock()
+# Interval in seconds between logging summaries of the statistics, or None:
+_lock_stats_log_interval = None
+_lock_stats_next_log_time = None
+# Holds longer than this many seconds are logged as warnings, or None:
+_hold_warning_threshold = None
+
+
+class LockTimeHistogram(object):
+    """Histogram of durations in seconds, with logarithmically spaced bins. Bin i
+    counts durations less than BIN_EDGES[i] and not less than BIN_EDGES[i - 1], with
+    the last bin counting durations of at least BIN_EDGES[-1]."""
+
+    # Powers of two from ~61us to 128s:
+    BIN_EDGES = tuple(2.0 ** n for n in range(-14, 8))
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BIN_EDGES) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        self.counts[bisect_right(self.BIN_EDGES, duration)] += 1
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def quantile(self, q):
+        """Upper bound of the bin containing the q quantile, i.e. a value that at
+        least a fraction q of durations were shorter than. Durations in the last bin
+        are bounded by the maximum duration."""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target and count:
+                if i < len(self.BIN_EDGES):
+                    return min(self.BIN_EDGES[i], self.max)
+                break
+        return self.max
+
+    def copy(self):
+        histogram = LockTimeHistogram()
+        histogram.counts = list(self.counts)
+        histogram.count = self.count
+        histogram.total = self.total
+        histogram.max = self.max
+        return histogram
+
+    def __repr__(self):
+        return '<%s: count=%d, mean=%.4gs, p50<=%.4gs, p99<=%.4gs, max=%.4gs>' % (
+            self.__class__.__name__,
+            self.count,
+            self.mean,
+            self.quantile(0.5),
+            self.quantile(0.99),
+            self.max,
+        )
+
+
+def enable_lock_stats(log_interval=None, hold_warning_threshold=None):
+    """Record how long each open of a file waits to acquire its zlock lock, and how
+    long the lock is then held, in per-file histograms that can be queried with
+    get_lock_stats(). If log_interval is given, a summary of the statistics recorded
+    so far is logged at most every log_interval seconds, when a file is closed, at
+    INFO level to the 'labscript_utils.h5_lock' logger. If hold_warning_threshold is
+    given, a warning is logged, including the stack from which the file was opened,
+    whenever a lock is held for longer than hold_warning_threshold seconds."""
+    global _lock_stats_enabled
+    global _lock_stats_log_interval
+    global _lock_stats_next_log_time
+    global _hold_warning_threshold
+    with _lock_stats_lock:
+        _lock_stats_enabled = True
+        _lock_stats_log_interval = log_interval
+        if log_interval is not None:
+            _lock_stats_next_log_time = monotonic() + log_interval
+        else:
+            _lock_stats_next_log_time = None
+        _hold_warning_threshold = hold_warning_threshold
+
+
+def disable_lock_stats():
+    """Stop recording lock statistics. Statistics recorded so far are kept until
+    reset_lock_stats() is called."""
+    global _lock_stats_enabled
+    with _lock_stats_lock:
+        _lock_stats_enabled = False
+
+
+def reset_lock_stats():
+    """Discard all lock statistics recorded so far"""
+    with _lock_stats_lock:
+        _lock_stats.clear()
+
+
+def get_lock_stats(path=None):
+    """Return lock statistics as a dict mapping each file's path (in the agnostic
+    form used as its zlock key) to a dict with keys 'wait' and 'hold', whose values
+    are LockTimeHistogram objects of how long opens of the file waited to acquire the
+    lock and how long it was then held. If path is given, return just that file's
+    dict, with empty histograms if nothing has been recorded. The histograms are
+    copies and are not updated by subsequent opens."""
+    with _lock_stats_lock:
+        if path is not None:
+            key = path_to_agnostic(path)
+            if key not in _lock_stats:
+                return {'wait': LockTimeHistogram(), 'hold': LockTimeHistogram()}
+            return {k: v.copy() for k, v in _lock_stats[key].items()}
+        return {
+            key: {k: v.copy() for k, v in stats.items()}
+            for key, stats in _lock_stats.items()
+        }
+
+
+def _format_lock_stats(stats):
+    # Sort by total hold time, so that the files whose locks were held the most are
+    # listed first:
+    items = sorted(stats.items(), key=lambda item: item[1]['hold'].total, reverse=True)
+    lines = ['h5_lock statistics for %d file(s):' % len(items)]
+    for key, histograms in items:
+        lines.append('  %s' % key)
+        lines.append('    wait: %r' % histograms['wait'])
+        lines.append('    hold: %r' % histograms['hold'])
+    return '\n'.join(lines)
+
+
+def _record_lock_times(key, wait_time, hold_time):
+    global _lock_stats_next_log_time
+    summary = None
+    with _lock_stats_lock:
+        if not _lock_stats_enabled:
+            return
+        try:
+            stats = _lock_stats[key]
+        except KeyError:
+            stats = _lock_stats[key] = {
+                'wait': LockTimeHistogram(),
+                'hold': LockTimeHistogram(),
+            }
+        stats['wait'].add(wait_time)
+        stats['hold'].add(hold_time)
+        now = monotonic()
+        if _lock_stats_next_log_time is not None and now >= _lock_stats_next_log_time:
+            summary = _format_lock_stats(_lock_stats)
+            _lock_stats_next_log_time = now + _lock_stats_log_interval
+    if summary is not None:
+        logger.info(summary)
+
+
+class _ReadCache(object):
+    """Local copies of files opened read-only, in a directory, totalling at most
+    max_bytes. Copies are named by a hash of the file's agnostic path, and are valid if
+    their size and modification time match the original, since shutil.copy2()
+    preserves the modification time. The least recently used copies are deleted to
+    stay within max_bytes. The directory may be shared by multiple processes, each of
+    which only keeps track of its own usage of copies, with copies from previous runs
+    considered used in order of access time. Temporary files left behind by processes
+    that died whilst copying are deleted once they are STALE_TEMP_AGE seconds old."""
+
+    STALE_TEMP_AGE = 600
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # {cached_path: size}, least recently used first:
+        self._entries = OrderedDict()
+        os.makedirs(directory, exist_ok=True)
+        existing = []
+        now = time()
+        for entry in os.scandir(directory):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            if entry.name.endswith('.h5'):
+                existing.append((stat.st_atime, entry.path, stat.st_size))
+            elif entry.name.endswith('.tmp'):
+                # Writing to a copy updates both times, so a copy in progress is
+                # recent by one or the other, depending on the platform:
+                if now - max(stat.st_mtime, stat.st_ctime) > self.STALE_TEMP_AGE:
+                    try:
+                        os.unlink(entry.path)
+                    except OSError:
+                        # Deleted by another process, or open on Windows:
+                        pass
+        for _, cached_path, size in sorted(existing):
+            self._entries[cached_path] = size
+        with self._lock:
+            self._evict()
+
+    def _cached_path(self, path):
+        key = path_to_agnostic(path)
+        filename = hashlib.sha1(key.encode('utf8')).hexdigest() + '.h5'
+        return os.path.join(self.directory, filename)
+
+    def get(self, path):
+        """Return the path to a valid local copy of the file at path, copying it if
+        necessary, or None if it is too large to cache. Must be called with at least a
+        read-only lock held on the file."""
+        source_stat = os.stat(path)
+        if source_stat.st_size > self.max_bytes:
+            return None
+        cached_path = self._cached_path(path)
+        try:
+            cached_stat = os.stat(cached_path)
+        except FileNotFoundError:
+            cached_stat = None
+        if (
+            cached_stat is not None
+            and cached_stat.st_size == source_stat.st_size
+            and cached_stat.st_mtime_ns == source_stat.st_mtime_ns
+        ):
+            with self._lock:
+                self.hits += 1
+                self._entries[cached_path] = cached_stat.st_size
+                self._entries.move_to_end(cached_path)
+            return cached_path
+        # Copy to a temporary file and move it into place, so that other processes
+        # never see a partial copy:
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        os.close(fd)
+        try:
+            shutil.copy2(path, temp_path)
+            os.replace(temp_path, cached_path)
+        except:
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            self.misses += 1
+            self._entries[cached_path] = source_stat.st_size
+            self._entries.move_to_end(cached_path)
+            self._evict(keep=cached_path)
+        return cached_path
+
+    def _evict(self, keep=None):
+        # Must be called with self._lock held
+        total = sum(self._entries.values())
+        for cached_path in list(self._entries):
+            if total <= self.max_bytes:
+                break
+            if cached_path == keep:
+                continue
+            total -= self._entries.pop(cached_path)
+            try:
+                os.unlink(cached_path)
+            except OSError:
+                # Already deleted by another process, or open on Windows:
+                pass
+
+    def info(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'max_bytes': self.max_bytes,
+                'currbytes': sum(self._entries.values()),
+            }
+
+
+_read_cache = None
+# Paths of the original files of cached copies currently open, and the number of Files
+# open on each copy, by HDF5 file number:
+_cache_sources = {}
+_cache_sources_lock = threading.Lock()
+
+
+def enable_read_cache(directory=None, max_bytes=10 * 1024 ** 3):
+    """Serve files opened read-only (mode='r') from local copies in the given
+    directory, by default a directory in the system temporary directory. A file is
+    copied on first being opened, and the copy used for subsequent opens for as long
+    as its size and modification time match the original. Copies are deleted, least
+    recently used first, to keep their total size below max_bytes. This is useful for
+    files on a network drive that are read repeatedly. The lock on the original file
+    is held as usual whilst the copy is open, and the filename attribute of the open
+    file, and of the file attribute of objects in it, is that of the original. Files
+    opened with swmr=True or with a driver are
+    not cached."""
+    global _read_cache
+    if directory is None:
+        directory = os.path.join(tempfile.gettempdir(), 'labscript-h5-cache')
+    _read_cache = _ReadCache(directory, max_bytes)
+
+
+def disable_read_cache():
+    """Stop serving read-only opens from local copies. Existing copies are left on
+    disk, and are used again if the cache is re-enabled with the same directory."""
+    global _read_cache
+    _read_cache = None
+
+
+def read_cache_info():
+    """Return a dict of the read cache's hits, misses, max_bytes, and currbytes,
+    the total size of the copies it is keeping, or None if the cache is disabled."""
+    read_cache = _read_cache
+    if read_cache is None:
+        return None
+    return read_cache.info()
+
+
+# How long to keep retrying opening a file for writing if HDF5 reports that it is
+# locked, which happens if SWMR readers, which do not use zlock, have it open:
+SWMR_READER_WAIT_TIMEOUT = 10
+
+
+def _hdf5_file_locking_enabled(kwds):
+    """Return whether HDF5 will lock files opened with the given keyword arguments,
+    and fail to open them if the locks cannot be acquired"""
+    locking = kwds.get('locking')
+    if locking is not None:
+        return locking is True or locking == 'true'
+    env = os.environ.get('HDF5_USE_FILE_LOCKING', 'TRUE').upper()
+    return env not in ('FALSE', '0', 'BEST_EFFORT')
+
+
 _File = h5py.File
 class File(_File):
+    """h5py.File subclass that acquires a zlock lock on the file whilst it is open.
+
+    An optional single-writer/multiple-reader (SWMR) mode is enabled if labconfig
+    contains:
+
+    [locking]
+    swmr = True
+
+    Readers that then open a file with mode='r' and swmr=True do not acquire a lock,
+    so they are not blocked by writers that have opened the file in SWMR mode. A
+    writer enters SWMR mode by setting f.swmr_mode = True once it has created all
+    groups and datasets it will write. Files must be created with libver='latest' for
+    this. With this option, writers default to libver='latest', and readers of files
+    in older formats acquire the lock as usual.
+
+    This relies on HDF5's own file locking. If a writer has the file open but not in
+    SWMR mode, opening the file fails, and the reader instead acquires the lock and
+    waits for the writer as usual. Writers likewise retry opening the file for up to
+    SWMR_READER_WAIT_TIMEOUT seconds whilst SWMR readers have it open, so they should
+    open files before readers do, as HDF5 requires. Readers acquire the lock if HDF5
+    file locking is disabled with HDF5_USE_FILE_LOCKING or the locking argument. The
+    option must only be enabled if HDF5 file locking works for every program that
+    opens the files. File locking is often not reliable between computers accessing
+    a network drive, which is what zlock is for."""
     def __init__(self, name, mode=None, driver=None, libver=None, **kwds):
-        if not isinstance(name, h5py._objects.ObjectID):
+        if isinstance(name, h5py._objects.ObjectID):
+            _File.__init__(self, name, mode, driver, libver, **kwds)
+            return
+        # Do not terminate upon SIGTERM while the file is open:
+        self.kill_lock = kill_lock
+        self.kill_lock.acquire()
+        try:
+            swmr = get_config()['swmr']
+            if swmr and mode != 'r' and libver is None:
+                libver = 'latest'
+            if (
+                swmr
+                and mode == 'r'
+                and kwds.get('swmr', False)
+                and _hdf5_file_locking_enabled(kwds)
+            ):
+                try:
+                    _File.__init__(self, name, mode, driver, libver, **kwds)
+                except OSError:
+                    # Probably a writer not in SWMR mode has the file open. Acquire
+                    # the lock to wait for it to close the file, and try again:
+                    pass
+                else:
+                    # Superblock version 3 is the file format supporting SWMR. Files
+                    # in older formats cannot be open by a writer in SWMR mode:
+                    if self.id.get_create_plist().get_version()[0] >= 3:
+                        return
+                    _File.close(self)
             kwargs = {}
             if mode == 'r':
                 kwargs['read_only'] = True
-            # Do not terminate upon SIGTERM while the file is open:
-            self.kill_lock = kill_lock
-            self.kill_lock.acquire()
+            key = path_to_agnostic(name)
             # Ask other zlock users not to open the file while we have it open:
-            self.zlock = Lock(path_to_agnostic(name), **kwargs)
-            self.zlock.acquire()
-        try:
-            _File.__init__(self, name, mode, driver, libver, **kwds)
+            if _lease_grace_period is not None or _leases:
+                zlock = _LeasedLock(key, **kwargs)
+            else:
+                zlock = Lock(key, **kwargs)
+            if _lock_stats_enabled:
+                start_time = monotonic()
+                zlock.acquire()
+                self._lock_stats = (key, start_time, monotonic())
+                if _hold_warning_threshold is not None:
+                    self._opened_from = traceback.extract_stack()[:-1]
+            else:
+                zlock.acquire()
+            try:
+                if (
+                    mode == 'r'
+                    and _read_cache is not None
+                    and isinstance(name, str)
+                    and driver is None
+                    and not kwds.get('swmr', False)
+                ):
+                    self._open_cached(_read_cache, name, libver, **kwds)
+                else:
+                    self._open(name, mode, driver, libver, **kwds)
+            except:
+                zlock.release()
+                raise
+            self.zlock = zlock
         except:
-            if hasattr(self, 'zlock'):
-                self.zlock.release()
-            if hasattr(self, 'kill_lock'):
-                self.kill_lock.release()
+            self.kill_lock.release()
             raise
 
+    def _open(self, name, mode, driver, libver, **kwds):
+        """Open the file, retrying for up to SWMR_READER_WAIT_TIMEOUT if SWMR mode is
+        enabled and opening it for writing fails because SWMR readers have it open"""
+        deadline = None
+        while True:
+            try:
+                _File.__init__(self, name, mode, driver, libver, **kwds)
+                return
+            except BlockingIOError:
+                if mode == 'r' or not get_config()['swmr']:
+                    raise
+                if deadline is None:
+                    deadline = monotonic() + SWMR_READER_WAIT_TIMEOUT
+                elif monotonic() > deadline:
+                    raise
+                sleep(0.01)
+
+    def _open_cached(self, read_cache, name, libver, **kwds):
+        """Open a local copy of the file from the read cache, falling back to opening
+        the file itself if this fails"""
+        try:
+            cached_path = read_cache.get(name)
+            if cached_path is not None:
+                _File.__init__(self, cached_path, 'r', None, libver, **kwds)
+                self._cache_fileno = self.id.fileno
+                with _cache_sources_lock:
+                    _, count = _cache_sources.get(self._cache_fileno, (None, 0))
+                    _cache_sources[self._cache_fileno] = (name, count + 1)
+                return
+        except OSError:
+            # Could not copy the file, or the copy was deleted by another process
+            # before we opened it
+            pass
+        self._open(name, 'r', None, libver, **kwds)
+
+    @property
+    def filename(self):
+        # The original's path if this is a cached copy, including for Files made from
+        # the identifier of an object in the file, as returned by its file attribute:
+        if _cache_sources and self.id.valid:
+            source = _cache_sources.get(self.id.fileno)
+            if source is not None:
+                return source[0]
+        return _File.filename.fget(self)
+
     def close(self):
         _File.close(self)
+        fileno = getattr(self, '_cache_fileno', None)
+        if fileno is not None:
+            del self._cache_fileno
+            with _cache_sources_lock:
+                name, count = _cache_sources.pop(fileno)
+                if count > 1:
+                    _cache_sources[fileno] = (name, count - 1)
         if hasattr(self, 'zlock'):
             self.zlock.release()
+            if hasattr(self, '_lock_stats'):
+                self._record_lock_stats()
         if hasattr(self, 'kill_lock'):
             self.kill_lock.release()
 
+    def _record_lock_stats(self):
+        key, start_time, acquired_time = self._lock_stats
+        del self._lock_stats
+        hold_time = monotonic() - acquired_time
+        _record_lock_times(key, acquired_time - start_time, hold_time)
+        threshold = _hold_warning_threshold
+        if threshold is not None and hold_time > threshold:
+            opened_from = getattr(self, '_opened_from', None)
+            msg = 'Lock on %s held for %.3fs, exceeding threshold of %.3fs.' % (
+                key,
+                hold_time,
+                threshold,
+            )
+            if opened_from is not None:
+                msg += ' File was opened at:\n' + ''.join(
+                    traceback.format_list(opened_from)
+                )
+            logger.warning(msg)
+
     # Overriding __exit__ is crucial. Since h5py.File.__exit__() holds h5py's
     # library-wide lock "phil", it calls close() whilst holding that lock. Our close()
     # method does not need the lock (h5py.File.close() does, but it acquires it itself
@@ -85,10 +887,187 @@ class File(_File):
         self.close()
 
 
+# Maximum number of threads in the executor used by AsyncFile to open and close files,
+# if one is not passed in. Takes effect if set before the first AsyncFile is opened:
+ASYNC_MAX_WORKERS = 4
+_async_executor = None
+_async_executor_lock = threading.Lock()
+
+
+def _get_async_executor():
+    global _async_executor
+    with _async_executor_lock:
+        if _async_executor is None:
+            _async_executor = ThreadPoolExecutor(
+                max_workers=ASYNC_MAX_WORKERS, thread_name_prefix='h5_lock'
+            )
+        return _async_executor
+
+
+class AsyncFile(object):
+    """Asynchronous context manager for opening a file from a coroutine:
+
+        async_file = AsyncFile(path, 'r')
+        async with async_file as f:
+            data = await async_file.run(lambda f: f['data'][:])
+
+    The zlock lock on the file is awaited without blocking the event loop, and the
+    file is opened and closed in an executor, by default a thread pool with at most
+    ASYNC_MAX_WORKERS threads, so that many files may be read concurrently from one
+    event loop. Arguments are as for h5py.File, plus the executor to use. Within the
+    block, f is a plain h5py.File, and operations on it block the event loop unless
+    passed to AsyncFile.run(). Each AsyncFile acquires its own lock, see AsyncLock."""
+
+    def __init__(self, name, mode=None, executor=None, **kwargs):
+        self.name = name
+        self.mode = mode
+        self.kwargs = kwargs
+        if executor is None:
+            executor = _get_async_executor()
+        self.executor = executor
+        self.file = None
+        self._lock = None
+        self._lock_stats = None
+
+    async def __aenter__(self):
+        key = path_to_agnostic(self.name)
+        loop = asyncio.get_event_loop()
+        # Do not terminate upon SIGTERM while the file is open:
+        kill_lock.acquire()
+        try:
+            lock = AsyncLock(key, read_only=self.mode == 'r')
+            start_time = monotonic()
+            await lock.acquire()
+            if _lock_stats_enabled:
+                self._lock_stats = (key, start_time, monotonic())
+            try:
+                self.file = await loop.run_in_executor(
+                    self.executor, lambda: _File(self.name, self.mode, **self.kwargs)
+                )
+            except:
+                await lock.release()
+                raise
+            self._lock = lock
+        except:
+            kill_lock.release()
+            raise
+        return self.file
+
+    async def run(self, func, *args):
+        """Call func(f, *args) in the executor, where f is the open h5py.File, and
+        return the result"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, func, self.file, *args)
+
+    async def __aexit__(self, type, value, traceback):
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(self.executor, self.file.close)
+        finally:
+            try:
+                await self._lock.release()
+            finally:
+                self._lock = None
+                kill_lock.release()
+        if self._lock_stats is not None:
+            key, start_time, acquired_time = self._lock_stats
+            self._lock_stats = None
+            now = monotonic()
+            _record_lock_times(key, acquired_time - start_time, now - acquired_time)
+
+
+def _find_merge_conflicts(source, destination, conflicts):
+    # Names of datasets in source that already exist in destination, or that are groups
+    # in one and not the other:
+    for name, item in source.items():
+        if name not in destination:
+            continue
+        existing = destination[name]
+        if isinstance(item, h5py.Group) and isinstance(existing, h5py.Group):
+            _find_merge_conflicts(item, existing, conflicts)
+        else:
+            conflicts.append(existing.name)
+    return conflicts
+
+
+def _merge(source, destination):
+    # Copy groups, datasets and attributes from source into destination, recursing
+    # into groups that exist in both:
+    for name, value in source.attrs.items():
+        destination.attrs[name] = value
+    for name, item in source.items():
+        if name in destination:
+            _merge(item, destination[name])
+        else:
+            source.copy(item, destination, name=name)
+
+
+class StagedWriter(object):
+    """Context manager for writing to a file without holding its lock for the whole
+    time spent writing:
+
+        with StagedWriter(path) as staging:
+            staging.create_dataset('images/camera', data=images)
+
+    Within the block, staging is an h5py.File for a temporary file in a local
+    directory, by default the system temporary directory, which is written to without
+    acquiring any lock. On exiting the block without an exception, the file at path
+    is opened for writing, acquiring its lock, and everything written to the staging
+    file is copied into it in one operation, merging into groups that already exist,
+    and overwriting existing attributes. Datasets that already exist in the file are
+    not overwritten; if there are any, ValueError is raised and nothing is copied.
+    Either way, the staging file is then deleted. This is useful for writing large
+    datasets to files on a network drive, where writing directly to the file would
+    hold its lock for the duration of a slow network write."""
+
+    def __init__(self, path, directory=None):
+        self.path = path
+        self.directory = directory
+        self.staging_path = None
+        self.staging = None
+
+    def __enter__(self):
+        fd, self.staging_path = tempfile.mkstemp(
+            suffix='.h5', prefix='staged-', dir=self.directory
+        )
+        os.close(fd)
+        try:
+            self.staging = _File(self.staging_path, 'w')
+        except:
+            os.unlink(self.staging_path)
+            raise
+        return self.staging
+
+    def commit(self):
+        """Copy the contents of the staging file into the file at path. Called on
+        exiting the context manager if there was no exception."""
+        self.staging.close()
+        with _File(self.staging_path, 'r') as staging:
+            with File(self.path, 'a') as f:
+                conflicts = _find_merge_conflicts(staging, f, [])
+                if conflicts:
+                    msg = 'Cannot merge staged data into %s, %s already exist(s)'
+                    raise ValueError(msg % (self.path, ', '.join(conflicts)))
+                _merge(staging, f)
+
+    def __exit__(self, type, value, traceback):
+        try:
+            if type is None:
+                self.commit()
+        finally:
+            self.staging.close()
+            os.unlink(self.staging_path)
+
+
 def hack_locks_onto_h5py():
     # Monkeypatch h5py so all files are locked:
     h5py.File = File
+    # And so that the file attribute of objects in files is also one of our Files, which
+    # are not locked when made from an object identifier like this, but report the
+    # original filename of files opened from the read cache:
+    h5py._hl.files.File = File
 
 
-connect_to_zlock_server()
+# The connection to the zlock server is made when a file is first opened, see
+# ls_zprocess.ensure_connected_to_zlock() and ls_zprocess.prewarm_zlock_connection().
 hack_locks_onto_h5py()
@@ -12,13 +12,34 @@
 #####################################################################
 import sys
 import os
-from socket import gethostbyname
+import threading
+import hashlib
+import tempfile
+import itertools
+import weakref
+import asyncio
+import ipaddress
+from collections import OrderedDict
+from functools import partial
+from socket import gethostbyname, gethostname
+from time import monotonic
+from types import SimpleNamespace
 from distutils.version import LooseVersion
 import zmq
+import zmq.asyncio
 
 import zprocess
 import zprocess.process_tree
-from zprocess.security import SecureContext
+import zprocess.utils
+from zprocess.clientserver import _Sender, _typecheck_or_convert_data
+from zprocess.security import (
+    SecureContext,
+    SecureSocket,
+    ip_is_loopback,
+    InsecureConnection,
+    INSECURE_CONNECT_ERROR,
+    INSECURE_RECV_WARNING,
+)
 from labscript_utils.labconfig import LabConfig
 from labscript_utils import dedent
 import zprocess.zlog
@@ -108,6 +129,30 @@ def get_config():
         config['allow_insecure'] = False
         if config['shared_secret'] is None and not config['allow_insecure']:
             raise ValueError(_ERR_NO_SHARED_SECRET.replace('/', os.sep))
+    try:
+        config['lock_backend'] = labconfig.get('locking', 'backend')
+    except (labconfig.NoOptionError, labconfig.NoSectionError):
+        config['lock_backend'] = 'zlock'
+    if config['lock_backend'] not in ('zlock', 'fcntl'):
+        msg = "locking/backend in labconfig must be 'zlock' or 'fcntl', not %s"
+        raise ValueError(msg % config['lock_backend'])
+    try:
+        config['swmr'] = labconfig.getboolean('locking', 'swmr')
+    except (labconfig.NoOptionError, labconfig.NoSectionError):
+        config['swmr'] = False
+    try:
+        config['lock_directory'] = labconfig.get('locking', 'lock_directory')
+    except (labconfig.NoOptionError, labconfig.NoSectionError):
+        lock_directory = os.path.join(tempfile.gettempdir(), 'labscript-locks')
+        config['lock_directory'] = lock_directory
+    try:
+        config['ipc'] = labconfig.getboolean('ipc', 'enabled')
+    except (labconfig.NoOptionError, labconfig.NoSectionError):
+        config['ipc'] = False
+    try:
+        config['ipc_directory'] = labconfig.get('ipc', 'directory')
+    except (labconfig.NoOptionError, labconfig.NoSectionError):
+        config['ipc_directory'] = os.path.join(tempfile.gettempdir(), 'labscript-ipc')
     try:
         config['logging_maxBytes'] = labconfig.getint('logging', 'maxBytes')
     except (labconfig.NoOptionError, labconfig.NoSectionError):
@@ -127,6 +172,9 @@ class ProcessTree(zprocess.ProcessTree):
     singleton."""
 
     _instance = None
+    # Held whilst creating the singleton, so that threads calling instance()
+    # concurrently do not each create one:
+    _instance_lock = threading.RLock()
 
     @classmethod
     def instance(cls):
@@ -139,24 +187,28 @@ class ProcessTree(zprocess.ProcessTree):
         # Otherwise, return previously initialised singleton for the top-level process:
         if cls._instance is not None:
             return cls._instance
-        # Otherwise, create that singleton and return it:
-        config = get_config()
-        cls._instance = cls(
-            shared_secret=config['shared_secret'],
-            allow_insecure=config['allow_insecure'],
-            zlock_host=config['zlock_host'],
-            zlock_port=config['zlock_port'],
-            zlog_host='localhost',
-            zlog_port=config['zlog_port'],
-        )
-        # Assign this to the default zprocess ProcessTree so that code using deprecated
-        # zprocess calls use this ProcessTree:
-        zprocess.process_tree._default_process_tree = cls._instance
-        # Assign the zlock client as the default zlock server so that code using
-        # deprecated zlock calls can use it:
-        zprocess.zlock._default_zlock_client = cls._instance.zlock_client
-
-        return cls._instance
+        with cls._instance_lock:
+            if cls._instance is not None:
+                return cls._instance
+            # Otherwise, create that singleton and return it:
+            config = get_config()
+            instance = cls(
+                shared_secret=config['shared_secret'],
+                allow_insecure=config['allow_insecure'],
+                zlock_host=config['zlock_host'],
+                zlock_port=config['zlock_port'],
+                zlog_host='localhost',
+                zlog_port=config['zlog_port'],
+            )
+            # Assign this to the default zprocess ProcessTree so that code using
+            # deprecated zprocess calls use this ProcessTree:
+            zprocess.process_tree._default_process_tree = instance
+            # Assign the zlock client as the default zlock server so that code using
+            # deprecated zlock calls can use it:
+            zprocess.zlock._default_zlock_client = instance.zlock_client
+            # Only now visible to other threads, fully set up:
+            cls._instance = instance
+            return instance
 
 
 class ZMQServer(zprocess.ZMQServer):
@@ -207,6 +259,7 @@ class ZMQClient(zprocess.ZMQClient):
     singleton."""
 
     _instance = None
+    _instance_lock = threading.Lock()
 
     def __init__(self):
         config = get_config()
@@ -215,15 +268,197 @@ class ZMQClient(zprocess.ZMQClient):
         zprocess.ZMQClient.__init__(
             self, shared_secret=shared_secret, allow_insecure=allow_insecure
         )
+        # The Interruptor waits for its XPUB socket to report each subscription and
+        # unsubscription, but by default XPUB only reports the first subscription and
+        # last unsubscription, so calls in multiple threads at once would hang. Have it
+        # report them all. zprocess.ZMQClient creates its Interruptor itself and
+        # provides no way to configure its socket, so we have to set the options on
+        # its private _xpub attribute. This is safe since it is done in the thread
+        # that created the socket, before the Interruptor has been used by any thread.
+        # The Interruptor only otherwise uses the socket whilst holding its lock.
+        xpub = getattr(self.interruptor, '_xpub', None)
+        if xpub is not None:
+            xpub.setsockopt(zmq.XPUB_VERBOSE, 1)
+            if hasattr(zmq, 'XPUB_VERBOSER'):
+                xpub.setsockopt(zmq.XPUB_VERBOSER, 1)
 
     @classmethod
     def instance(cls):
         # Return previously initialised singleton:
         if cls._instance is None:
-            # Create singleton:
-            cls._instance = cls()
+            with cls._instance_lock:
+                if cls._instance is None:
+                    # Create singleton:
+                    cls._instance = cls()
         return cls._instance
-        
+
+
+class _PooledSender(_Sender):
+    """A zprocess _Sender used by only one thread at a time. Its socket is stored in an
+    ordinary attribute instead of thread-locally, so that ZMQClientPool can close it
+    from whichever thread finds it idle."""
+
+    def __init__(self, *args, **kwargs):
+        _Sender.__init__(self, *args, **kwargs)
+        self.local = SimpleNamespace()
+
+
+class _PooledSenders(object):
+    """The senders of a ZMQClient, for use by one thread with one server"""
+
+    # {name: (dtype, push_only)}:
+    SENDER_TYPES = {
+        'get': ('pyobj', False),
+        'get_multipart': ('multipart', False),
+        'get_string': ('string', False),
+        'get_raw': ('raw', False),
+        'push': ('pyobj', True),
+        'push_multipart': ('multipart', True),
+        'push_string': ('string', True),
+        'push_raw': ('raw', True),
+    }
+
+    def __init__(self, shared_secret, allow_insecure, interruptor):
+        self.shared_secret = shared_secret
+        self.allow_insecure = allow_insecure
+        self.interruptor = interruptor
+        self.senders = {}
+        self.last_used = monotonic()
+        self.in_use = False
+
+    def sender(self, name):
+        try:
+            return self.senders[name]
+        except KeyError:
+            dtype, push_only = self.SENDER_TYPES[name]
+            sender = self.senders[name] = _PooledSender(
+                dtype,
+                push_only=push_only,
+                shared_secret=self.shared_secret,
+                allow_insecure=self.allow_insecure,
+                interruptor=self.interruptor,
+            )
+            return sender
+
+    def close(self):
+        # Must not be called whilst in use:
+        for sender in self.senders.values():
+            if hasattr(sender.local, 'sock'):
+                sender.local.sock.close(linger=0)
+                del sender.local.sock
+        self.senders.clear()
+
+
+class ZMQClientPool(object):
+    """A pool of ZMQClient senders configured with settings from labconfig for
+    security, used by the zmq_get() and zmq_push() etc functions in this module. Each
+    thread has its own sockets to each server it sends to, so that threads do not
+    contend for sockets, and a thread sending to several servers in turn does not
+    have to reconnect each time. Each thread keeps sockets to at most
+    MAX_SERVERS_PER_THREAD servers, closing those least recently used. Every
+    SWEEP_INTERVAL seconds, a call in any thread closes the sockets of all threads that
+    have not been used for IDLE_TIMEOUT seconds, and those of threads that have exited.
+    Calls may be interrupted with ZMQClient.instance().interrupt(). Call the
+    .instance() classmethod to get the singleton."""
+
+    MAX_SERVERS_PER_THREAD = 16
+    IDLE_TIMEOUT = 60
+    SWEEP_INTERVAL = 5
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        config = get_config()
+        self.shared_secret = config['shared_secret']
+        self.allow_insecure = config['allow_insecure']
+        # Share the singleton ZMQClient's Interruptor, so that interrupting it
+        # interrupts calls made via the pool:
+        self.interruptor = ZMQClient.instance().interruptor
+        # Held whilst accessing any thread's servers. A socket is only closed by a
+        # thread other than its own whilst not in use, and acquiring the lock in
+        # between provides the memory barrier zmq requires to move it between threads:
+        self.lock = threading.Lock()
+        # {thread: {(host, port): _PooledSenders}}, least recently used first:
+        self.servers = {}
+        self.next_sweep = monotonic()
+
+    @classmethod
+    def instance(cls):
+        # Return previously initialised singleton:
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    # Create singleton:
+                    cls._instance = cls()
+        return cls._instance
+
+    def call(self, name, host, port, args, kwargs):
+        """Call this thread's sender of the given name, as for the methods of ZMQClient,
+        for sending to the given host and port, with the given args and kwargs"""
+        thread = threading.current_thread()
+        key = (host, int(port))
+        with self.lock:
+            servers = self.servers.setdefault(thread, OrderedDict())
+            try:
+                senders = servers[key]
+            except KeyError:
+                senders = servers[key] = _PooledSenders(
+                    self.shared_secret, self.allow_insecure, self.interruptor
+                )
+            else:
+                servers.move_to_end(key)
+            senders.in_use = True
+            to_close = self._evict(servers)
+        for unused in to_close:
+            unused.close()
+        try:
+            return senders.sender(name)(*args, **kwargs)
+        finally:
+            with self.lock:
+                senders.in_use = False
+                senders.last_used = monotonic()
+
+    def _evict(self, servers):
+        # Remove and return senders in excess of the maximum from the given thread's
+        # servers, and if it is time to, idle senders of all threads and senders of
+        # threads that have exited. Must be called whilst holding self.lock.
+        evicted = []
+        while len(servers) > self.MAX_SERVERS_PER_THREAD:
+            _, oldest = servers.popitem(last=False)
+            evicted.append(oldest)
+        now = monotonic()
+        if now < self.next_sweep:
+            return evicted
+        self.next_sweep = now + self.SWEEP_INTERVAL
+        for thread, thread_servers in list(self.servers.items()):
+            if not thread.is_alive():
+                evicted.extend(thread_servers.values())
+                del self.servers[thread]
+                continue
+            for key, senders in list(thread_servers.items()):
+                if not senders.in_use and now - senders.last_used > self.IDLE_TIMEOUT:
+                    evicted.append(thread_servers.pop(key))
+        return evicted
+
+    def close(self):
+        """Close this thread's sockets"""
+        with self.lock:
+            servers = self.servers.pop(threading.current_thread(), {})
+        for senders in servers.values():
+            senders.close()
+
+
+def _pooled_call(name, args, kwargs):
+    # Call the pool's sender of the given name, with the arguments of a ZMQClient
+    # method: port, host='localhost', ...
+    port = args[0] if args else kwargs['port']
+    if len(args) > 1:
+        host = args[1]
+    else:
+        host = kwargs.get('host', 'localhost')
+    return ZMQClientPool.instance().call(name, host, port, args, kwargs)
+
 
 class Context(SecureContext):
     """Subclass of zprocess.security.SecureContext configured with settings from
@@ -254,13 +489,650 @@ class Context(SecureContext):
         return SecureContext.socket(self, *args, **kwargs)
 
 
+def _fcntl_lockfile_path(key):
+    directory = get_config()['lock_directory']
+    os.makedirs(directory, exist_ok=True)
+    filename = hashlib.sha1(key.encode('utf8')).hexdigest() + '.lock'
+    return os.path.join(directory, filename)
+
+
+def _fcntl_lockfile_is_current(fd, path):
+    """Return whether the lock file open as fd, which we have just locked, is still
+    the one at path, and not one deleted by a previous holder since we opened it"""
+    try:
+        path_stat = os.stat(path)
+    except FileNotFoundError:
+        return False
+    fd_stat = os.fstat(fd)
+    return (fd_stat.st_dev, fd_stat.st_ino) == (path_stat.st_dev, path_stat.st_ino)
+
+
+def _fcntl_unlock(fd, path):
+    """Unlock and close a lock file, deleting it first if no other lock is held on it.
+    Lockers that opened the file before it was deleted see that it is no longer current
+    once they lock it, and open it again."""
+    import fcntl
+
+    try:
+        # If this succeeds, no-one else holds a lock on the file:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        pass
+    else:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+
+class _FcntlLockEntry(object):
+    def __init__(self, fd, path, read_only):
+        self.fd = fd
+        self.path = path
+        self.read_only = read_only
+        self.level = 1
+
+
+class FcntlLock(object):
+    """A lock with the same interface and semantics as a zprocess zlock Lock, but
+    implemented with flock() advisory locks on a lock file in a local directory,
+    instead of requests to a zlock server. Used by Lock() if labconfig contains:
+
+    [locking]
+    backend = fcntl
+
+    This is only suitable if all programs accessing the locked files run on the same
+    computer, and is not available on Windows. As with zlock, locks are held per
+    thread, are reentrant within a thread, and may be shared if read_only is True. The
+    lock files are created in the directory given by 'lock_directory' in the
+    [locking] section of labconfig, defaulting to a directory in the system temporary
+    directory, and are deleted by the last holder to release them."""
+
+    # Locks held by this process, for reentrancy: {(key, thread_id): _FcntlLockEntry}
+    _held = {}
+    _held_lock = threading.Lock()
+
+    def __init__(self, key, read_only=False):
+        self.key = key
+        self.read_only = read_only
+        self._holder = None
+
+    def _lockfile_path(self):
+        return _fcntl_lockfile_path(self.key)
+
+    def acquire(self, timeout=None, read_only=None):
+        # timeout is accepted for compatibility with zlock, where it is the time after
+        # which the server releases the lock. The kernel releases flock() locks when
+        # the process holding them exits, so no such timeout is needed.
+        import fcntl
+
+        if read_only is None:
+            read_only = self.read_only
+        holder = (self.key, threading.get_ident())
+        with self._held_lock:
+            entry = self._held.get(holder)
+            if entry is not None:
+                if entry.read_only and not read_only:
+                    # The same error the zlock server gives:
+                    msg = 'error: lock already held read-only, '
+                    msg += 'cannot re-enter as writer'
+                    raise zmq.ZMQError(msg)
+                entry.level += 1
+                self._holder = holder
+                return
+        path = self._lockfile_path()
+        while True:
+            # flock() locks belong to the open file, so a separate open file per thread
+            # makes threads of this process exclude each other, as with zlock:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH if read_only else fcntl.LOCK_EX)
+            except:
+                os.close(fd)
+                raise
+            if _fcntl_lockfile_is_current(fd, path):
+                break
+            os.close(fd)
+        with self._held_lock:
+            self._held[holder] = _FcntlLockEntry(fd, path, read_only)
+        self._holder = holder
+
+    def release(self):
+        with self._held_lock:
+            entry = self._held[self._holder]
+            entry.level -= 1
+            if entry.level > 0:
+                return
+            del self._held[self._holder]
+        _fcntl_unlock(entry.fd, entry.path)
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, type, value, traceback):
+        self.release()
+
+
+def ipc_endpoint(name, port):
+    """Return the ipc:// endpoint on which the zlock or zlog server (according to name)
+    listening on the given TCP port also listens if ipc is enabled in labconfig:
+
+    [ipc]
+    enabled = True
+    directory = <optional directory for the socket files>
+
+    Unix domain sockets have lower latency than TCP connections to localhost. When
+    enabled, servers launched with 'python -m labscript_utils.zlock' or
+    'python -m labscript_utils.zlog' listen on both, and clients on the same computer
+    connect over ipc if the server is listening on its ipc endpoint, otherwise
+    falling back to TCP. Not available on Windows."""
+    directory = get_config()['ipc_directory']
+    return 'ipc://' + os.path.join(directory, '%s-%s.sock' % (name, port))
+
+
+class _IPCServerSocket(SecureSocket):
+    """A SecureSocket that, as well as TCP peers, accepts messages from ipc:// peers,
+    whose Peer-Address is not an IP address. These are on the local computer, so their
+    peer_ip is set to the loopback address."""
+
+    def recv(self, flags=0, copy=True, track=False):
+        while True:
+            msg = zmq.Socket.recv(self, flags=flags, copy=False, track=track)
+            try:
+                peer_ip = ipaddress.ip_address(msg.get('Peer-Address'))
+            except zmq.ZMQError:
+                # Not sent over TCP or ipc, see SecureSocket.recv():
+                self.peer_ip = None
+            except ValueError:
+                # An ipc peer:
+                self.peer_ip = '127.0.0.1'
+            else:
+                if peer_ip.version == 6 and peer_ip.ipv4_mapped is not None:
+                    peer_ip = peer_ip.ipv4_mapped
+                self.peer_ip = str(peer_ip)
+                is_loopback = ip_is_loopback(self.peer_ip)
+                if not (is_loopback or self.secure or self.allow_insecure):
+                    # Insecure message from an external address. Warn and disregard
+                    # it as SecureSocket.recv() does:
+                    warning = INSECURE_RECV_WARNING % self.peer_ip
+                    if self.logger is not None:
+                        self.logger.warning(warning)
+                    elif (
+                        sys.stderr is not None
+                        and zprocess.utils._get_fileno(sys.stderr) >= 0
+                    ):
+                        sys.stderr.write(warning + '\n')
+                    continue
+            if copy:
+                return msg.bytes
+            return msg
+
+
+class _IPCServerContext(SecureContext):
+    """A SecureContext whose sockets are _IPCServerSockets"""
+
+    _socket_class = _IPCServerSocket
+
+
+class _IPCServerMixin(object):
+    """Mixin for the zprocess zlock and zlog servers to additionally listen on the
+    ipc:// endpoint ipc_endpoint. The servers create their sockets with the
+    SecureContext they assign to self.context when run, so we substitute an
+    _IPCServerContext for it, in order that the server's socket is created as an
+    _IPCServerSocket. zprocess SecureSockets only bind TCP and inproc endpoints, so the
+    server's socket is bound to the ipc:// endpoint directly. The socket was already
+    configured as a CurveZMQ server when it was bound to its TCP endpoint, so the same
+    security applies."""
+
+    ipc_endpoint = None
+
+    @property
+    def context(self):
+        return self._context
+
+    @context.setter
+    def context(self, context):
+        if context is not None and not isinstance(context, _IPCServerContext):
+            context = _IPCServerContext.instance(shared_secret=self.shared_secret)
+        self._context = context
+
+    def _mainloop(self):
+        # Called in the server thread, after the TCP endpoint has been bound:
+        os.makedirs(get_config()['ipc_directory'], exist_ok=True)
+        zmq.Socket.bind(self.router, self.ipc_endpoint)
+        return super(_IPCServerMixin, self)._mainloop()
+
+
+def _connect_ipc(sock, endpoint):
+    # Connect a SecureSocket to an ipc:// endpoint, configuring CurveZMQ as
+    # SecureSocket.connect() would for a tcp:// endpoint. Unlike with a timeout passed
+    # to SecureSocket.connect(), this does not wait for authentication to succeed.
+    if sock.secure:
+        sock._configure_curve(server=False)
+    zmq.Socket.connect(sock, endpoint)
+
+
+class _IPCZLockClient(zprocess.zlock.ZLockClient):
+    """A zlock client that connects to the server's ipc:// endpoint"""
+
+    def __init__(self, endpoint, *args, **kwargs):
+        self.endpoint = endpoint
+        zprocess.zlock.ZLockClient.__init__(self, *args, **kwargs)
+
+    def _new_socket(self, timeout=None):
+        context = SecureContext.instance(shared_secret=self.shared_secret)
+        self.local.sock = context.socket(zmq.REQ, allow_insecure=self.allow_insecure)
+        try:
+            self.local.sock.setsockopt(zmq.LINGER, 0)
+            self.local.poller = zmq.Poller()
+            self.local.poller.register(self.local.sock, zmq.POLLIN)
+            _connect_ipc(self.local.sock, self.endpoint)
+            self.local.client_id = zprocess.zlock._ensure_bytes(self._make_client_id())
+        except:
+            # Didn't work, don't keep it:
+            del self.local.sock
+            raise
+
+
+class _IPCZLogClient(zprocess.zlog.ZLogClient):
+    """A zlog client that connects to the server's ipc:// endpoint"""
+
+    def __init__(self, endpoint, *args, **kwargs):
+        self.endpoint = endpoint
+        zprocess.zlog.ZLogClient.__init__(self, *args, **kwargs)
+
+    def _new_socket(self, timeout=None):
+        context = SecureContext.instance(shared_secret=self.shared_secret)
+        self.local.sock = context.socket(zmq.DEALER, allow_insecure=self.allow_insecure)
+        try:
+            self.local.sock.setsockopt(zmq.LINGER, 0)
+            self.local.sock.set_hwm(1000)
+            _connect_ipc(self.local.sock, self.endpoint)
+            self.local.poller = zmq.Poller()
+            self.local.poller.register(self.local.sock, zmq.POLLIN)
+        except Exception:
+            # Do not keep the socket:
+            del self.local.sock
+            raise
+
+
+def _prefer_ipc_client(name, client_class):
+    """If ipc is enabled in labconfig, and the zlock or zlog server (according to name)
+    is on localhost and is listening on its ipc endpoint, replace the ProcessTree's
+    client for it with one connecting over ipc. Returns the client in use."""
+    process_tree = ProcessTree.instance()
+    attr = name + '_client'
+    client = getattr(process_tree, attr)
+    if not get_config()['ipc'] or isinstance(client, client_class):
+        return client
+    if gethostbyname(client.host) != gethostbyname('localhost'):
+        return client
+    endpoint = ipc_endpoint(name, client.port)
+    if not os.path.exists(endpoint.split('ipc://', 1)[1]):
+        return client
+    ipc_client = client_class(
+        endpoint,
+        host=client.host,
+        port=client.port,
+        shared_secret=client.shared_secret,
+        allow_insecure=client.allow_insecure,
+    )
+    if name == 'zlock':
+        ipc_client.process_name = client.process_name
+        ipc_client.default_timeout = client.default_timeout
+    try:
+        ipc_client.ping(timeout=1)
+    except zmq.ZMQError:
+        # Perhaps a stale socket file from a server that is no longer running. Keep
+        # using TCP:
+        return client
+    setattr(process_tree, attr, ipc_client)
+    if name == 'zlock':
+        zprocess.zlock._default_zlock_client = ipc_client
+    return ipc_client
+
+
 def Lock(*args, **kwargs):
+    if get_config()['lock_backend'] == 'fcntl':
+        return FcntlLock(*args, **kwargs)
+    ensure_connected_to_zlock()
     if 'read_only' in kwargs and not _zlock_server_supports_readwrite:
         # Ignore read_only argument if the server does not support it:
         del kwargs['read_only']
     return ProcessTree.instance().lock(*args, **kwargs)
 
 
+class _AsyncSocket(object):
+    """A zmq.asyncio socket connected to the given host and port, configured with
+    security settings from labconfig in the same way as a zprocess SecureSocket
+    configures itself as a CurveZMQ client. If endpoint is given, it is connected to
+    instead of the host and port, as an ipc:// endpoint. Unlike the synchronous
+    clients, connecting does not wait for authentication with the server to succeed,
+    so failed authentication will appear as the server not responding."""
+
+    # zmq.asyncio Contexts shadowing each SecureContext, by id:
+    _contexts = {}
+
+    def __init__(self, socket_type, host, port, endpoint=None, linger=0):
+        config = get_config()
+        context = SecureContext.instance(shared_secret=config['shared_secret'])
+        if endpoint is None:
+            host = gethostbyname(host)
+            endpoint = 'tcp://%s:%s' % (host, port)
+            if not (context.secure or config['allow_insecure'] or ip_is_loopback(host)):
+                raise InsecureConnection(INSECURE_CONNECT_ERROR % endpoint)
+        try:
+            async_context = self._contexts[id(context)]
+        except KeyError:
+            async_context = zmq.asyncio.Context.shadow(context.underlying)
+            self._contexts[id(context)] = async_context
+        self.socket = async_context.socket(socket_type)
+        try:
+            self.socket.setsockopt(zmq.LINGER, linger)
+            self.socket.ipv6 = True
+            if context.secure:
+                self.socket.curve_publickey = context.client_publickey
+                self.socket.curve_secretkey = context.client_secretkey
+                self.socket.curve_serverkey = context.server_publickey
+            self.socket.connect(endpoint)
+        except:
+            self.socket.close(linger=0)
+            raise
+
+    def close(self, linger=0):
+        self.socket.close(linger=linger)
+
+
+class _AsyncSocketPool(object):
+    """Idle _AsyncSockets, by event loop and server, for reuse by subsequent requests.
+    Each request takes a socket from the pool or creates a new one, so that concurrent
+    requests each have their own socket, and returns it to the pool only if the
+    request completed normally. At most MAX_IDLE_PER_SERVER idle sockets are kept per
+    server and event loop."""
+
+    MAX_IDLE_PER_SERVER = 32
+
+    def __init__(self):
+        # {loop: {(socket_type, host, port, endpoint): [_AsyncSocket]}}:
+        self._idle = weakref.WeakKeyDictionary()
+
+    def _sockets(self, key):
+        loop = asyncio.get_event_loop()
+        return self._idle.setdefault(loop, {}).setdefault(key, [])
+
+    def get(self, socket_type, host, port, endpoint=None, linger=0):
+        sockets = self._sockets((socket_type, host, port, endpoint))
+        if sockets:
+            return sockets.pop()
+        return _AsyncSocket(socket_type, host, port, endpoint, linger)
+
+    def put(self, sock, socket_type, host, port, endpoint=None):
+        sockets = self._sockets((socket_type, host, port, endpoint))
+        if len(sockets) < self.MAX_IDLE_PER_SERVER:
+            sockets.append(sock)
+        else:
+            sock.close()
+
+
+_async_sockets = _AsyncSocketPool()
+
+
+async def _async_request(
+    dtype,
+    push_only,
+    port,
+    host='localhost',
+    data=None,
+    timeout=5,
+    raise_server_exceptions=True,
+):
+    # Coroutine counterpart to the ZMQClient get*()/push*() methods, see
+    # zprocess.clientserver._Sender.__call__():
+    data = _typecheck_or_convert_data(data, dtype)
+    port = int(port)
+    if push_only:
+        socket_type = zmq.PUSH
+        # Allow up to 1 second to send unsent messages on socket shutdown:
+        linger = 1000
+    else:
+        socket_type = zmq.REQ
+        linger = 0
+    sock = _async_sockets.get(socket_type, host, port, linger=linger)
+    if dtype == 'pyobj':
+        send = partial(sock.socket.send_pyobj, protocol=zprocess.PICKLE_PROTOCOL)
+        recv = sock.socket.recv_pyobj
+    elif dtype == 'multipart':
+        send = sock.socket.send_multipart
+        recv = sock.socket.recv_multipart
+    elif dtype == 'string':
+        send = sock.socket.send_string
+        recv = sock.socket.recv_string
+    else:
+        send = sock.socket.send
+        recv = sock.socket.recv
+    try:
+        try:
+            await asyncio.wait_for(send(data), timeout)
+        except asyncio.TimeoutError:
+            msg = 'Could not send data to server: timed out'
+            raise zprocess.utils.TimeoutError(msg)
+        if not push_only:
+            try:
+                response = await asyncio.wait_for(recv(), timeout)
+            except asyncio.TimeoutError:
+                msg = 'No response from server: timed out'
+                raise zprocess.utils.TimeoutError(msg)
+    except:
+        # Any exceptions, including cancellation, we want to stop using this socket:
+        sock.close()
+        raise
+    _async_sockets.put(sock, socket_type, host, port)
+    if push_only:
+        return
+    if isinstance(response, Exception) and raise_server_exceptions:
+        raise response
+    return response
+
+
+async def zmq_get_async(*args, **kwargs):
+    """Coroutine counterpart to zmq_get(), with the same arguments, that does not
+    block the event loop. Cannot be interrupted with ZMQClient.interrupt(), cancel the
+    task instead. Unlike zmq_get(), does not wait for authentication with the server
+    to succeed before sending, so failed authentication appears as a timeout."""
+    return await _async_request('pyobj', False, *args, **kwargs)
+
+
+async def zmq_get_multipart_async(*args, **kwargs):
+    """Coroutine counterpart to zmq_get_multipart(), see zmq_get_async()"""
+    return await _async_request('multipart', False, *args, **kwargs)
+
+
+async def zmq_get_string_async(*args, **kwargs):
+    """Coroutine counterpart to zmq_get_string(), see zmq_get_async()"""
+    return await _async_request('string', False, *args, **kwargs)
+
+
+async def zmq_get_raw_async(*args, **kwargs):
+    """Coroutine counterpart to zmq_get_raw(), see zmq_get_async()"""
+    return await _async_request('raw', False, *args, **kwargs)
+
+
+async def zmq_push_async(*args, **kwargs):
+    """Coroutine counterpart to zmq_push(), see zmq_get_async()"""
+    return await _async_request('pyobj', True, *args, **kwargs)
+
+
+async def zmq_push_multipart_async(*args, **kwargs):
+    """Coroutine counterpart to zmq_push_multipart(), see zmq_get_async()"""
+    return await _async_request('multipart', True, *args, **kwargs)
+
+
+async def zmq_push_string_async(*args, **kwargs):
+    """Coroutine counterpart to zmq_push_string(), see zmq_get_async()"""
+    return await _async_request('string', True, *args, **kwargs)
+
+
+async def zmq_push_raw_async(*args, **kwargs):
+    """Coroutine counterpart to zmq_push_raw(), see zmq_get_async()"""
+    return await _async_request('raw', True, *args, **kwargs)
+
+
+# The zlock server's response to a request made whilst another from the same client is
+# pending, see zprocess.zlock.server.ERR_CONCURRENT:
+_ZLOCK_ERR_CONCURRENT = (
+    'error: multiple concurrent requests with same key and client_id'
+)
+
+
+class AsyncLock(object):
+    """An asyncio counterpart to Lock(), whose acquire() and release() methods are
+    coroutines that do not block the event loop while waiting for the lock. Can also
+    be used with 'async with'. Each acquisition is made as a separate zlock client, so
+    unlike Lock(), AsyncLocks are not reentrant: coroutines in the same thread exclude
+    each other, and acquiring a lock already held by the same thread will wait for it
+    to be released. If labconfig configures the fcntl lock backend, flock() is polled
+    instead."""
+
+    # Seconds to wait for a response from the zlock server:
+    RESPONSE_TIMEOUT = 5
+    _client_ids = itertools.count()
+    # Tasks releasing locks whose acquisition was cancelled:
+    _abandoned = set()
+
+    def __init__(self, key, read_only=False):
+        self.key = key
+        self.read_only = read_only
+        self._client_id = None
+        self._fd = None
+        self._path = None
+
+    @classmethod
+    async def _request(cls, messages):
+        client = ProcessTree.instance().zlock_client
+        server = (zmq.REQ, client.host, client.port, getattr(client, 'endpoint', None))
+        sock = _async_sockets.get(*server)
+        try:
+            await sock.socket.send_multipart(messages)
+            response = await asyncio.wait_for(sock.socket.recv(), cls.RESPONSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            sock.close()
+            raise zmq.ZMQError('No response from zlock server: timed out')
+        except:
+            # Including cancellation. The REQ/REP cadence is broken, don't reuse:
+            sock.close()
+            raise
+        _async_sockets.put(sock, *server)
+        return response.decode('utf8')
+
+    async def acquire(self, timeout=None):
+        """Acquire the lock. timeout is the time after which the zlock server will
+        release the lock, defaulting to the zlock client's default timeout."""
+        if get_config()['lock_backend'] == 'fcntl':
+            await self._acquire_fcntl()
+            return
+        if not _connected_to_zlock:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, ensure_connected_to_zlock)
+        if timeout is None:
+            timeout = ProcessTree.instance().zlock_client.default_timeout
+        client_id = ':'.join(
+            [gethostname(), str(os.getpid()), 'asyncio-%d' % next(self._client_ids)]
+        ).encode('utf8')
+        key = self.key.encode('utf8') if isinstance(self.key, str) else self.key
+        messages = [b'acquire', key, client_id, str(timeout).encode('utf8')]
+        if self.read_only and _zlock_server_supports_readwrite:
+            messages.append(b'read_only')
+        acquisition = asyncio.ensure_future(self._acquire(messages))
+        try:
+            await asyncio.shield(acquisition)
+        except asyncio.CancelledError:
+            # The server does not accept a release whilst our request is pending, and
+            # would go on to grant the lock to a request nobody is waiting on, holding
+            # it until it timed out. So finish acquiring the lock in the background,
+            # and then release it:
+            task = asyncio.ensure_future(
+                self._release_abandoned(acquisition, key, client_id)
+            )
+            # The event loop only keeps weak references to tasks:
+            self._abandoned.add(task)
+            task.add_done_callback(self._abandoned.discard)
+            raise
+        self._client_id = client_id
+
+    @classmethod
+    async def _acquire(cls, messages):
+        # Make acquisition requests until the server grants the lock:
+        while True:
+            response = await cls._request(messages)
+            if response == 'ok':
+                return
+            elif response == _ZLOCK_ERR_CONCURRENT:
+                # A request of ours whose response we did not receive is still pending
+                # on the server. It will stop waiting on it within a second:
+                await asyncio.sleep(0.1)
+            elif response != 'retry':
+                raise zmq.ZMQError(response)
+
+    @classmethod
+    async def _release_abandoned(cls, acquisition, key, client_id):
+        try:
+            await acquisition
+        except (Exception, asyncio.CancelledError):
+            # The lock was not acquired:
+            return
+        try:
+            await cls._request([b'release', key, client_id])
+        except Exception:
+            pass
+
+    async def release(self):
+        if self._fd is not None:
+            self._release_fcntl()
+            return
+        key = self.key.encode('utf8') if isinstance(self.key, str) else self.key
+        client_id, self._client_id = self._client_id, None
+        response = await self._request([b'release', key, client_id])
+        if response != 'ok':
+            raise zmq.ZMQError(response)
+
+    async def _acquire_fcntl(self):
+        import fcntl
+
+        operation = fcntl.LOCK_SH if self.read_only else fcntl.LOCK_EX
+        path = _fcntl_lockfile_path(self.key)
+        delay = 0.001
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                while True:
+                    try:
+                        fcntl.flock(fd, operation | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        await asyncio.sleep(delay)
+                        delay = min(2 * delay, 0.05)
+            except:
+                os.close(fd)
+                raise
+            if _fcntl_lockfile_is_current(fd, path):
+                break
+            os.close(fd)
+        self._fd = fd
+        self._path = path
+
+    def _release_fcntl(self):
+        fd, self._fd = self._fd, None
+        _fcntl_unlock(fd, self._path)
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, type, value, traceback):
+        await self.release()
+
+
 def Event(*args, **kwargs):
     return ProcessTree.instance().event(*args, **kwargs)
 
@@ -270,35 +1142,35 @@ def Handler(*args, **kwargs):
 
 
 def zmq_get(*args, **kwargs):
-    return ZMQClient.instance().get(*args, **kwargs)
+    return _pooled_call('get', args, kwargs)
 
 
 def zmq_get_multipart(*args, **kwargs):
-    return ZMQClient.instance().get_multipart(*args, **kwargs)
+    return _pooled_call('get_multipart', args, kwargs)
 
 
 def zmq_get_string(*args, **kwargs):
-    return ZMQClient.instance().get_string(*args, **kwargs)
+    return _pooled_call('get_string', args, kwargs)
 
 
 def zmq_get_raw(*args, **kwargs):
-    return ZMQClient.instance().get_raw(*args, **kwargs)
+    return _pooled_call('get_raw', args, kwargs)
 
 
 def zmq_push(*args, **kwargs):
-    return ZMQClient.instance().push(*args, **kwargs)
+    return _pooled_call('push', args, kwargs)
 
 
 def zmq_push_multipart(*args, **kwargs):
-    return ZMQClient.instance().push_multipart(*args, **kwargs)
+    return _pooled_call('push_multipart', args, kwargs)
 
 
 def zmq_push_string(*args, **kwargs):
-    return ZMQClient.instance().push_string(*args, **kwargs)
+    return _pooled_call('push_string', args, kwargs)
 
 
 def zmq_push_raw(*args, **kwargs):
-    return ZMQClient.instance().push_raw(*args, **kwargs)
+    return _pooled_call('push_raw', args, kwargs)
 
 
 def RemoteProcessClient(host, port=None):
@@ -308,30 +1180,112 @@ def RemoteProcessClient(host, port=None):
     return ProcessTree.instance().remote_process_client(host, port)
 
 
-ZLOCK_DEFAULT_TIMEOUT = 45
-_zlock_server_supports_readwrite = False
+# Seconds to wait for a zlock or zlog server we started to respond:
+DAEMON_STARTUP_TIMEOUT = 15
+# Whether we started each server, and how long connecting to it took:
+_daemon_startup_info = {}
 
-def connect_to_zlock_server():
-    # Ensure we are connected to a zlock server, and start one if one is supposed
-    # to be running on localhost but is not.
-    client = ProcessTree.instance().zlock_client
+
+def _connect_to_daemon(name, client, module):
+    """Ping the server of a zlock or zlog client. If the server is on localhost and
+    is not running, start it with 'python -m <module> --daemon', and poll it with
+    exponentially increasing timeouts until it responds or DAEMON_STARTUP_TIMEOUT
+    elapses. Records whether the server was started, and the time taken, in
+    _daemon_startup_info[name]."""
+    start_time = monotonic()
+    started = False
     if gethostbyname(client.host) == gethostbyname('localhost'):
         try:
             # short connection timeout if localhost, don't want to
             # waste time:
             client.ping(timeout=0.05)
         except zmq.ZMQError:
-            # No zlock server running on localhost. Start one. It will run forever, even
+            # No server running on localhost. Start one. It will run forever, even
             # after this program exits. This is important for other programs which might
             # be using it. I don't really consider this bad practice since the server is
             # typically supposed to be running all the time:
-            zprocess.start_daemon(
-                [sys.executable, '-m', 'labscript_utils.zlock', '--daemon']
-            )
-            # Try again. Longer timeout this time, give it time to start up:
-            client.ping(timeout=15)
+            zprocess.start_daemon([sys.executable, '-m', module, '--daemon'])
+            started = True
+            deadline = monotonic() + DAEMON_STARTUP_TIMEOUT
+            timeout = 0.05
+            while True:
+                try:
+                    client.ping(timeout=timeout)
+                    break
+                except zmq.ZMQError:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        raise
+                    timeout = min(2 * timeout, 1, remaining)
     else:
         client.ping()
+    _daemon_startup_info[name] = {
+        'started': started,
+        'elapsed': monotonic() - start_time,
+    }
+
+
+def bootstrap_daemons():
+    """Connect to the zlock and zlog servers concurrently, starting them if they
+    are supposed to be running on localhost but are not, so that a program starting on
+    a fresh computer does not wait for each in turn. Returns a dict mapping 'zlock' and
+    'zlog' to dicts with keys 'started', whether this process started the server, and
+    'elapsed', the time in seconds taken to connect to it. Servers this process had
+    already connected to are omitted, as is zlock if labconfig configures the fcntl
+    lock backend. Raises the exception of the first server that could not be connected
+    to, if any."""
+    tasks = [('zlock', ensure_connected_to_zlock), ('zlog', ensure_connected_to_zlog)]
+    exceptions = {}
+    # Create the ProcessTree, which both connections configure, before starting the
+    # threads:
+    ProcessTree.instance()
+    already_connected = {
+        'zlock': _connected_to_zlock or get_config()['lock_backend'] == 'fcntl',
+        'zlog': _connected_to_zlog,
+    }
+
+    def connect(name, func):
+        try:
+            func()
+        except Exception as e:
+            exceptions[name] = e
+
+    threads = []
+    for name, func in tasks:
+        if not already_connected[name]:
+            thread = threading.Thread(
+                target=connect, args=(name, func), name='%s bootstrap' % name
+            )
+            thread.start()
+            threads.append(thread)
+    for thread in threads:
+        thread.join()
+    for name, _ in tasks:
+        if name in exceptions:
+            raise exceptions[name]
+    return {
+        name: dict(_daemon_startup_info[name])
+        for name, _ in tasks
+        if not already_connected[name] and name in _daemon_startup_info
+    }
+
+
+ZLOCK_DEFAULT_TIMEOUT = 45
+_zlock_server_supports_readwrite = False
+_connected_to_zlock = False
+_zlock_connection_lock = threading.Lock()
+
+def connect_to_zlock_server():
+    # Ensure we are connected to a zlock server, and start one if one is supposed
+    # to be running on localhost but is not.
+    global _connected_to_zlock
+    if get_config()['lock_backend'] == 'fcntl':
+        # No server required:
+        _connected_to_zlock = True
+        return
+    client = ProcessTree.instance().zlock_client
+    _connect_to_daemon('zlock', client, 'labscript_utils.zlock')
+    client = _prefer_ipc_client('zlock', _IPCZLockClient)
 
     # Check if the zlock server supports read-write locks:
     global _zlock_server_supports_readwrite
@@ -343,6 +1297,42 @@ def connect_to_zlock_server():
     # The user can call these functions to change the timeouts later if they
     # are not to their liking:
     client.set_default_timeout(ZLOCK_DEFAULT_TIMEOUT)
+    _connected_to_zlock = True
+
+
+def ensure_connected_to_zlock():
+    """Ensure we are connected to a zlock server, calling connect_to_zlock_server() if
+    this has not already been done. Called by Lock(), so that programs only connect
+    to the zlock server, possibly starting it, once they first need a lock."""
+    if _connected_to_zlock:
+        return
+    with _zlock_connection_lock:
+        if not _connected_to_zlock:
+            connect_to_zlock_server()
+
+
+def prewarm_zlock_connection():
+    """Connect to the zlock server in a background thread, so that the first lock
+    acquired does not have to wait for this. Can be called early in a program's
+    startup. If connecting fails, the exception is not raised, and connecting is
+    instead retried when a lock is first needed, raising the exception if it fails
+    again. Returns the thread."""
+
+    def prewarm():
+        try:
+            ensure_connected_to_zlock()
+        except Exception:
+            pass
+
+    # Create the ProcessTree on the calling thread, rather than concurrently with any
+    # other threads the program starts meanwhile:
+    try:
+        ProcessTree.instance()
+    except Exception:
+        pass
+    thread = threading.Thread(target=prewarm, name='zlock prewarm', daemon=True)
+    thread.start()
+    return thread
 
 
 _connected_to_zlog = False
@@ -356,22 +1346,7 @@ def ensure_connected_to_zlog():
         return
     # setup connection with the zlog server:
     client = ProcessTree.instance().zlog_client
-    if gethostbyname(client.host) == gethostbyname('localhost'):
-        try:
-            # short connection timeout if localhost, don't want to
-            # waste time:
-            client.ping(timeout=0.05)
-        except zmq.ZMQError:
-            # No zlog server running on localhost. Start one. It will run forever, even
-            # after this program exits. This is important for other programs which might
-            # be using it. I don't really consider this bad practice since the server is
-            # typically supposed to be running all the time:
-            zprocess.start_daemon(
-                [sys.executable, '-m', 'labscript_utils.zlog', '--daemon']
-            )
-            # Try again. Longer timeout this time, give it time to start up:
-            client.ping(timeout=15)
-    else:
-        client.ping()
+    _connect_to_daemon('zlog', client, 'labscript_utils.zlog')
+    _prefer_ipc_client('zlog', _IPCZLogClient)
     _connected_to_zlog = True
 
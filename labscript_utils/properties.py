@@ -1,12 +1,22 @@
 import sys
 import json
+import struct
 from base64 import b64encode, b64decode
-from collections.abc import Iterable, Mapping
+from collections.abc import Iterable, Mapping, MutableMapping
+from itertools import islice
+from urllib.parse import quote
 import numpy as np
 
 
 JSON_IDENTIFIER = 'Content-Type: application/json '
 BASE64_IDENTIFIER = 'Content-Transfer-Encoding: base64 '
+BINARY_IDENTIFIER = 'Content-Type: application/x-labscript-properties '
+DATASET_IDENTIFIER = 'Content-Type: application/x-hdf5-dataset '
+
+# Group in which set_attributes() stores array values too large for attributes. Each
+# is stored in a subgroup named after the group the attribute belongs to, see
+# _attribute_datasets_path():
+ATTRIBUTE_DATASETS_GROUP = '/_attribute_datasets'
 
 VALID_PROPERTY_LOCATIONS = {
     "connection_table_properties",
@@ -15,47 +25,219 @@ VALID_PROPERTY_LOCATIONS = {
     }
 
 
-def _check_dicts(o):
-    if isinstance(o, Mapping):
-        if not all(isinstance(k, (str, bytes)) for k in o.keys()):
-            raise TypeError("Cannot JSON encode dictionary with non-string keys")
-        for item in o.values():
-            _check_dicts(item)
-    elif isinstance(o, Iterable) and not isinstance(o, (str, bytes)):
-        for item in o:
-            _check_dicts(item)
-
-
-def _encode_bytestrings(o):
-    """Encode all bytestring values (not keys) to base64 with a prefix"""
-    if isinstance(o, Mapping):
-        return {key: _encode_bytestrings(value) for key, value in o.items()}
-    elif isinstance(o, Iterable) and not isinstance(o, (str, bytes)):
-        return list([_encode_bytestrings(value) for value in o])
-    elif isinstance(o, bytes):
-        return BASE64_IDENTIFIER + str(b64encode(o).decode())
-    else:
+def _encode(o):
+    """Check that all dictionary keys are strings, and encode all bytestring values
+    (not keys) to base64 with a prefix, in a single pass. Other iterables are
+    converted to lists. Containers are only copied if something in them needs to
+    change, otherwise the original object is returned."""
+    if isinstance(o, (str, int, float)) or o is None:
         return o
-
-
-def _decode_bytestrings(o):
-    """Decode all base64-encoded values (not keys) to bytestrings"""
-    if isinstance(o, Mapping):
-        return {key: _decode_bytestrings(value) for key, value in o.items()}
-    elif isinstance(o, Iterable) and not isinstance(o, (str, bytes)):
-        return list([_decode_bytestrings(value) for value in o])
-    elif isinstance(o, str) and o.startswith(BASE64_IDENTIFIER):
-        return b64decode(o[len(BASE64_IDENTIFIER):])
+    elif isinstance(o, bytes):
+        return BASE64_IDENTIFIER + b64encode(o).decode()
+    elif isinstance(o, Mapping):
+        # Non-dict mappings are always copied to a dict:
+        result = None if isinstance(o, dict) else {}
+        for i, (key, value) in enumerate(o.items()):
+            if not isinstance(key, (str, bytes)):
+                raise TypeError("Cannot JSON encode dictionary with non-string keys")
+            encoded = _encode(value)
+            if result is None and encoded is not value:
+                # First change, copy the items so far:
+                result = dict(islice(o.items(), i))
+            if result is not None:
+                result[key] = encoded
+        return o if result is None else result
+    elif isinstance(o, np.ndarray):
+        return _encode(o.tolist())
+    elif isinstance(o, (list, tuple)):
+        # Tuples are encoded by json the same as lists, so need not be converted:
+        result = None
+        for i, value in enumerate(o):
+            encoded = _encode(value)
+            if result is None and encoded is not value:
+                result = list(o[:i])
+            if result is not None:
+                result.append(encoded)
+        return o if result is None else result
+    elif isinstance(o, Iterable):
+        return [_encode(value) for value in o]
+    return o
+
+
+def _decode_bytestring(s):
+    """Decode a string to a bytestring if it is base64-encoded with our prefix"""
+    if s.startswith(BASE64_IDENTIFIER):
+        return b64decode(s[len(BASE64_IDENTIFIER):])
+    return s
+
+
+def _decode_list(o):
+    """Decode base64-encoded values in a list in-place. Dicts need not be decoded,
+    since _decode_object_hook() has already done it for them."""
+    for i, value in enumerate(o):
+        if isinstance(value, str):
+            o[i] = _decode_bytestring(value)
+        elif isinstance(value, list):
+            _decode_list(value)
+    return o
+
+
+def _decode_object_hook(o):
+    """Decode all base64-encoded values (not keys) of a dict in-place as it is
+    parsed"""
+    for key, value in o.items():
+        if isinstance(value, str):
+            o[key] = _decode_bytestring(value)
+        elif isinstance(value, list):
+            _decode_list(value)
+    return o
+
+
+# Type codes and struct formats for the binary encoding. Lengths and counts are
+# little-endian unsigned 32 bit integers. Integers are stored in the smallest of int8,
+# int32 or int64 that fits them, or as decimal strings if they do not fit in an int64.
+# Floats are stored as float64.
+_NONE = b'N'
+_TRUE = b'T'
+_FALSE = b'F'
+_INT8 = b'c'
+_INT32 = b'j'
+_INT = b'i'
+_BIGINT = b'I'
+_FLOAT = b'f'
+_STR = b's'
+_BYTES = b'b'
+_LIST = b'l'
+_DICT = b'd'
+
+_LENGTH = struct.Struct('<I')
+_INT8_STRUCT = struct.Struct('<b')
+_INT32_STRUCT = struct.Struct('<i')
+_INT64 = struct.Struct('<q')
+_FLOAT64 = struct.Struct('<d')
+
+_INT64_MIN = -(2 ** 63)
+_INT64_MAX = 2 ** 63 - 1
+
+
+def _encode_binary(o, chunks):
+    """Append the binary encoding of o to the list chunks"""
+    if o is None:
+        chunks.append(_NONE)
+    elif isinstance(o, (bool, np.bool_)):
+        chunks.append(_TRUE if o else _FALSE)
+    elif isinstance(o, (int, np.integer)):
+        o = int(o)
+        if -128 <= o <= 127:
+            chunks.append(_INT8 + _INT8_STRUCT.pack(o))
+        elif -2 ** 31 <= o < 2 ** 31:
+            chunks.append(_INT32 + _INT32_STRUCT.pack(o))
+        elif _INT64_MIN <= o <= _INT64_MAX:
+            chunks.append(_INT + _INT64.pack(o))
+        else:
+            data = str(o).encode('utf8')
+            chunks.append(_BIGINT + _LENGTH.pack(len(data)) + data)
+    elif isinstance(o, (float, np.floating)):
+        chunks.append(_FLOAT + _FLOAT64.pack(o))
+    elif isinstance(o, str):
+        data = o.encode('utf8')
+        chunks.append(_STR + _LENGTH.pack(len(data)))
+        chunks.append(data)
+    elif isinstance(o, bytes):
+        chunks.append(_BYTES + _LENGTH.pack(len(o)))
+        chunks.append(bytes(o))
+    elif isinstance(o, Mapping):
+        chunks.append(_DICT + _LENGTH.pack(len(o)))
+        for key, value in o.items():
+            if not isinstance(key, str):
+                raise TypeError("Cannot encode dictionary with non-string keys")
+            data = key.encode('utf8')
+            chunks.append(_LENGTH.pack(len(data)))
+            chunks.append(data)
+            _encode_binary(value, chunks)
+    elif isinstance(o, np.ndarray):
+        _encode_binary(o.tolist(), chunks)
+    elif isinstance(o, Iterable):
+        if not isinstance(o, (list, tuple)):
+            o = list(o)
+        chunks.append(_LIST + _LENGTH.pack(len(o)))
+        for value in o:
+            _encode_binary(value, chunks)
     else:
-        return o
+        raise TypeError("Cannot encode object of type %s" % type(o).__name__)
+
+
+def _decode_binary(data, offset):
+    """Decode the binary-encoded object starting at the given offset in data,
+    returning it and the offset of the next object"""
+    code = data[offset:offset + 1]
+    offset += 1
+    if code == _NONE:
+        return None, offset
+    elif code == _TRUE:
+        return True, offset
+    elif code == _FALSE:
+        return False, offset
+    elif code == _INT8:
+        return _INT8_STRUCT.unpack_from(data, offset)[0], offset + _INT8_STRUCT.size
+    elif code == _INT32:
+        return _INT32_STRUCT.unpack_from(data, offset)[0], offset + _INT32_STRUCT.size
+    elif code == _INT:
+        return _INT64.unpack_from(data, offset)[0], offset + _INT64.size
+    elif code == _FLOAT:
+        return _FLOAT64.unpack_from(data, offset)[0], offset + _FLOAT64.size
+    elif code in (_STR, _BYTES, _BIGINT):
+        length = _LENGTH.unpack_from(data, offset)[0]
+        offset += _LENGTH.size
+        value = data[offset:offset + length]
+        offset += length
+        if code == _STR:
+            return value.decode('utf8'), offset
+        elif code == _BIGINT:
+            return int(value), offset
+        return value, offset
+    elif code == _LIST:
+        count = _LENGTH.unpack_from(data, offset)[0]
+        offset += _LENGTH.size
+        result = []
+        for _ in range(count):
+            value, offset = _decode_binary(data, offset)
+            result.append(value)
+        return result, offset
+    elif code == _DICT:
+        count = _LENGTH.unpack_from(data, offset)[0]
+        offset += _LENGTH.size
+        result = {}
+        for _ in range(count):
+            length = _LENGTH.unpack_from(data, offset)[0]
+            offset += _LENGTH.size
+            key = data[offset:offset + length].decode('utf8')
+            offset += length
+            result[key], offset = _decode_binary(data, offset)
+        return result, offset
+    raise ValueError("Invalid type code %r in binary-encoded properties" % code)
+
+
+def is_binary(value):
+    """Return whether value has been serialised with serialise_binary()"""
+    if isinstance(value, np.void):
+        value = value.tobytes()
+    if isinstance(value, bytes):
+        return value[:len(BINARY_IDENTIFIER)] == BINARY_IDENTIFIER.encode('utf8')
+    return False
 
 
 def is_json(value):
+    """Return whether value is a serialised value that deserialise() can decode.
+    Despite the name, this is True for values in the binary encoding as well as for
+    JSON, so that existing code checking is_json() before calling deserialise()
+    handles both."""
     if isinstance(value, bytes):
-        return value[:len(JSON_IDENTIFIER)] == JSON_IDENTIFIER.encode('utf8')
+        if value[:len(JSON_IDENTIFIER)] == JSON_IDENTIFIER.encode('utf8'):
+            return True
     elif isinstance(value, str):
         return value.startswith(JSON_IDENTIFIER)
-    return False
+    return is_binary(value)
 
 
 def _default(o):
@@ -66,48 +248,287 @@ def _default(o):
 
 
 def serialise(value):
-    _check_dicts(value)
-    value = _encode_bytestrings(value)
-    json_string = json.dumps(value, default=_default)
+    json_string = json.dumps(_encode(value), default=_default)
     return JSON_IDENTIFIER + json_string
 
 
+def serialise_binary(value):
+    """Serialise a value in a compact binary encoding, which unlike JSON can contain
+    bytestrings without base64-encoding them. The result is a bytestring starting with
+    BINARY_IDENTIFIER, which can be stored in HDF5 as np.void(result)."""
+    chunks = [BINARY_IDENTIFIER.encode('utf8')]
+    _encode_binary(value, chunks)
+    return b''.join(chunks)
+
+
 def deserialise(value):
     assert is_json(value)
-    return _decode_bytestrings(json.loads(value[len(JSON_IDENTIFIER):]))
+    if is_binary(value):
+        if isinstance(value, np.void):
+            value = value.tobytes()
+        data = value[len(BINARY_IDENTIFIER):]
+        result, offset = _decode_binary(data, 0)
+        if offset != len(data):
+            raise ValueError("Trailing data in binary-encoded properties")
+        return result
+    json_string = value[len(JSON_IDENTIFIER):]
+    identifier = BASE64_IDENTIFIER
+    if isinstance(json_string, bytes):
+        identifier = identifier.encode('utf8')
+    if identifier not in json_string:
+        # Nothing to decode:
+        return json.loads(json_string)
+    result = json.loads(json_string, object_hook=_decode_object_hook)
+    if isinstance(result, str):
+        return _decode_bytestring(result)
+    elif isinstance(result, list):
+        return _decode_list(result)
+    return result
+
+
+def _as_large_array(val, threshold):
+    """Return val as a numeric numpy array if it is an array, list or tuple of at
+    least threshold bytes, otherwise None"""
+    if not isinstance(val, (np.ndarray, list, tuple)):
+        return None
+    try:
+        array = np.asarray(val)
+    except ValueError:
+        # Ragged nested sequences:
+        return None
+    if array.dtype.kind not in 'biufc' or array.nbytes < threshold:
+        return None
+    return array
+
+
+def _escape_name(name):
+    """Escape a string for use as a single HDF5 object name, with no slashes and
+    never '.' or empty. Distinct strings give distinct names."""
+    return quote(name, safe='').replace('.', '%2E')
+
+
+def _attribute_datasets_path(group):
+    """Return the path of the group in which datasets for the attributes of the given
+    group are stored. The group's whole path is escaped into a single name, so that
+    these datasets cannot clash with the datasets of its child groups"""
+    return ATTRIBUTE_DATASETS_GROUP + '/' + _escape_name(group.name)
+
+
+def _set_dataset_attribute(group, key, array, compression=None):
+    """Store an array as a dataset in ATTRIBUTE_DATASETS_GROUP, and set the attribute
+    to a reference to it"""
+    path = _attribute_datasets_path(group) + '/' + _escape_name(key)
+    h5_file = group.file
+    if path in h5_file:
+        del h5_file[path]
+    # Compression requires chunking, otherwise let h5py decide:
+    chunks = True if compression is not None else None
+    h5_file.create_dataset(path, data=array, chunks=chunks, compression=compression)
+    group.attrs[key] = DATASET_IDENTIFIER + path
+
+
+def is_dataset_reference(value):
+    """Return whether an attribute value is a reference to a dataset stored by
+    set_attributes() in place of a large array"""
+    if isinstance(value, bytes):
+        return value[:len(DATASET_IDENTIFIER)] == DATASET_IDENTIFIER.encode('utf8')
+    elif isinstance(value, str):
+        return value.startswith(DATASET_IDENTIFIER)
+    return False
+
+
+def _decode_attribute(group, value):
+    """Return the value of an attribute of the given group, reading it from its
+    dataset if it is a dataset reference, and deserialising it if it is serialised"""
+    if is_dataset_reference(value):
+        if isinstance(value, bytes):
+            value = value.decode('utf8')
+        return group.file[value[len(DATASET_IDENTIFIER):]][()]
+    elif is_json(value):
+        return deserialise(value)
+    return value
+
+
+# How set_attributes() should store each value. _UNKNOWN values are stored by
+# attempting to store them natively, and serialising them if h5py raises an exception
+# saying they are not supported:
+_NATIVE = 'native'
+_SERIALISED = 'serialised'
+_DATASET = 'dataset'
+_UNKNOWN = 'unknown'
+
+# Scalar types h5py can store as attributes, not including int, which can only be
+# stored if it fits in an int64 or uint64:
+_NATIVE_SCALAR_TYPES = (bool, float, complex, str, bytes, np.generic)
+
+
+def _classify(val):
+    """Return whether val can be stored natively as a HDF5 attribute, must be
+    serialised, or whether this cannot be known without attempting to store it, using
+    only type checks"""
+    if val is None or isinstance(val, (Mapping, set, frozenset)):
+        # h5py does not support None, but doesn't raise a TypeError for it either:
+        return _SERIALISED
+    elif isinstance(val, _NATIVE_SCALAR_TYPES):
+        return _NATIVE
+    elif isinstance(val, int):
+        return _NATIVE if -2 ** 63 <= val < 2 ** 64 else _SERIALISED
+    elif isinstance(val, np.ndarray):
+        return _NATIVE if val.dtype.kind in 'biufcS' else _UNKNOWN
+    elif isinstance(val, (list, tuple)):
+        # Flat sequences of numbers, or of strings, become arrays:
+        if all(isinstance(item, (int, float)) for item in val):
+            if all(-2 ** 63 <= item < 2 ** 63 for item in val if isinstance(item, int)):
+                return _NATIVE
+        elif all(isinstance(item, str) for item in val):
+            return _NATIVE
+    return _UNKNOWN
+
+
+def _set_attribute_fallback(group, key, val, binary):
+    """Store an attribute natively, serialising it if h5py raises an exception saying
+    it does not support its type"""
+    try:
+        group.attrs[key] = val
+    except TypeError as e:
+        # If type not supported by HDF5, store as JSON
+        if 'has no native HDF5 equivalent' in str(e):
+            if binary:
+                group.attrs[key] = np.void(serialise_binary(val))
+            else:
+                group.attrs[key] = serialise(val)
+        else:
+            raise
 
 
-def set_attributes(group, attributes):
+def set_attributes(
+    group, attributes, binary=False, dataset_threshold=None, compression=None
+):
     """Add attributes to a HDF5 group, serialising them to JSON if they do not map to
-    native HDF5 datatypes"""
+    native HDF5 datatypes. If binary is True, serialise them with serialise_binary()
+    instead, storing them as opaque HDF5 data. Files written this way can only be
+    read by versions of labscript_utils that support the binary encoding.
+
+    If dataset_threshold is not None, numeric arrays, lists and tuples of at least
+    that many bytes are stored as datasets in ATTRIBUTE_DATASETS_GROUP instead, with
+    the given compression (e.g. 'gzip'), if any. This avoids the 64kB limit on the
+    size of HDF5 attributes. The attribute is set to a reference to the dataset, which
+    get_attributes() and get_attribute() read when the attribute is requested.
+
+    How to store each value is decided from its type and all serialisation is done
+    before any attributes are written. Only values whose type does not determine
+    whether HDF5 supports them, such as nested lists, are stored by attempting to
+    write them natively first."""
+    prepared = []
     for key, val in attributes.items():
-        try:
-            # Workaround for h5py not supporting None but not raising a TypeError:
-            if val is None:
-                raise TypeError('has no native HDF5 equivalent')
+        if dataset_threshold is not None:
+            array = _as_large_array(val, dataset_threshold)
+            if array is not None:
+                prepared.append((key, _DATASET, array))
+                continue
+        kind = _classify(val)
+        if kind == _SERIALISED:
+            val = np.void(serialise_binary(val)) if binary else serialise(val)
+        prepared.append((key, kind, val))
+
+    # Datasets of any attributes previously stored as datasets, which must be deleted
+    # if they are now being stored as attributes:
+    datasets = group.file.get(_attribute_datasets_path(group))
+
+    for key, kind, val in prepared:
+        if kind == _DATASET:
+            _set_dataset_attribute(group, key, val, compression)
+            continue
+        if datasets is not None and _escape_name(key) in datasets:
+            del datasets[_escape_name(key)]
+        if kind == _UNKNOWN:
+            _set_attribute_fallback(group, key, val, binary)
+        else:
             group.attrs[key] = val
-        except TypeError as e:
-            # If type not supported by HDF5, store as JSON
-            if 'has no native HDF5 equivalent' in str(e):
-                json_string = serialise(val)
-                group.attrs[key] = json_string
-            else:
-                raise
 
 
-def get_attributes(group):
+class LazyAttributes(MutableMapping):
+    """A mapping of the attributes of a HDF5 group, as returned by get_attributes(),
+    but which reads and decodes each attribute only when it is first accessed, caching
+    the result. The attribute names are read up front. Attributes first accessed after
+    the file has been closed are read by opening the file again.
+
+    Like the dict returned by get_attributes(), the mapping can be modified, but this
+    does not modify the attributes in the file."""
+
+    def __init__(self, group):
+        self._group = group
+        self._name = group.name
+        self._filename = group.file.filename
+        # dict used as an ordered set:
+        self._keys = dict.fromkeys(group.attrs.keys())
+        self._values = {}
+
+    def _read(self, key):
+        if self._group.id.valid:
+            return _decode_attribute(self._group, self._group.attrs[key])
+        import h5py
+
+        with h5py.File(self._filename, 'r') as h5_file:
+            group = h5_file[self._name]
+            return _decode_attribute(group, group.attrs[key])
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        if key not in self._keys:
+            raise KeyError(key)
+        value = self._read(key)
+        self._values[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._keys[key] = None
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        del self._keys[key]
+        self._values.pop(key, None)
+
+    def __contains__(self, key):
+        # Override so that membership does not require decoding:
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return '<%s of %s with keys %s>' % (
+            self.__class__.__name__,
+            self._name,
+            list(self._keys),
+        )
+
+    def copy(self):
+        """Return a dict of all attributes, decoding any not yet accessed"""
+        return dict(self)
+
+
+def get_attributes(group, lazy=False):
     """Return attributes of a HDF5 group as a dict, deserialising any that have been
-    encoded as JSON"""
-    return {k: deserialise(v) if is_json(v) else v for k, v in group.attrs.items()}
+    encoded as JSON or in the binary encoding, and reading any that have been stored as
+    datasets. If lazy is True, return a LazyAttributes instead, which only reads and
+    decodes each attribute when it is accessed."""
+    if lazy:
+        return LazyAttributes(group)
+    return {k: _decode_attribute(group, v) for k, v in group.attrs.items()}
 
 
 def get_attribute(group, name):
     """Return the attribute of the given name from the given HDF5 group, deserialising
-    it if it has been encoded as JSON"""
-    value = group.attrs[name]
-    if is_json(value):
-        return deserialise(value)
-    return value
+    it if it has been encoded as JSON or in the binary encoding, or reading it if it
+    has been stored as a dataset"""
+    return _decode_attribute(group, group.attrs[name])
 
 
 def set_device_properties(h5_file, device_name, properties):
@@ -156,6 +577,44 @@ def _get_unit_conversion_parameters(h5_file, device_name):
     return deserialise(json_string)
 
 
+def _get_con_table_column_many(h5_file, device_names, column):
+    """Return a dict of the deserialised values of the given column of the connection
+    table for each of the given devices, reading the dataset only once"""
+    dataset = h5_file['connection table']
+    namecol_dtype = dataset['name'].dtype
+    if namecol_dtype.type is not np.bytes_ and namecol_dtype.kind != 'O':
+        raise TypeError(namecol_dtype)
+    # Index rows by name, whether the names are np.bytes_ or vlenstr:
+    rows = {}
+    for i, name in enumerate(dataset['name']):
+        rows[name.decode('utf8') if isinstance(name, bytes) else name] = i
+    values = dataset[column]
+    result = {}
+    for device_name in device_names:
+        try:
+            row = rows[device_name]
+        except KeyError:
+            raise KeyError(device_name) from None
+        result[device_name] = deserialise(values[row])
+    return result
+
+
+def get_many(h5_file, device_names, location):
+    """Return a dict of the properties of each of the given devices, as would be
+    returned by get() for each one. For properties stored in the connection table, the
+    dataset is read only once for all devices."""
+    if location == 'device_properties':
+        return {name: _get_device_properties(h5_file, name) for name in device_names}
+    elif location == 'connection_table_properties':
+        return _get_con_table_column_many(h5_file, device_names, 'properties')
+    elif location == 'unit_conversion_parameters':
+        return _get_con_table_column_many(
+            h5_file, device_names, 'unit conversion params'
+        )
+    else:
+        raise ValueError('location must be one of %s'%str(VALID_PROPERTY_LOCATIONS))
+
+
 def get(h5_file, device_name, location):
     if location == 'device_properties':
         return _get_device_properties(h5_file, device_name)
@@ -16,16 +16,37 @@
 
     python -m labscript_utils.zlock [--daemon]
 
-If --daemon is specified, the zlock server will be started in the background.
+If --daemon is specified, the zlock server will be started in the background. If ipc
+is enabled in labconfig, the server is run in a Python process that also listens on
+an ipc:// endpoint, see labscript_utils.ls_zprocess.ipc_endpoint().
 """
 import sys
 import subprocess
 from socket import gethostbyname
-from labscript_utils.ls_zprocess import get_config
+from labscript_utils.ls_zprocess import get_config, ipc_endpoint, _IPCServerMixin
 from labscript_utils.setup_logging import LOG_PATH
 from zprocess import start_daemon
 
+def _run_ipc_server():
+    # Run the zprocess zlock server with the remaining command line arguments, using a
+    # subclass of its server class that additionally listens on an ipc:// endpoint:
+    import zprocess.zlock.__main__ as server_main
+
+    i = sys.argv.index('--ipc-server')
+    endpoint = sys.argv[i + 1]
+    del sys.argv[i : i + 2]
+
+    class IPCZMQLockServer(_IPCServerMixin, server_main.ZMQLockServer):
+        ipc_endpoint = endpoint
+
+    server_main.ZMQLockServer = IPCZMQLockServer
+    server_main.main()
+
+
 def main():
+    if '--ipc-server' in sys.argv:
+        _run_ipc_server()
+        return
     config = get_config()
 
     if gethostbyname(config['zlock_host']) != gethostbyname('localhost'):
@@ -35,10 +56,16 @@ def main():
         )
         raise ValueError(msg)
 
+    if config['ipc']:
+        endpoint = ipc_endpoint('zlock', config['zlock_port'])
+        server = ['labscript_utils.zlock', '--ipc-server', endpoint]
+    else:
+        server = ['zprocess.zlock']
+
     cmd = [
         sys.executable,
         '-m',
-        'zprocess.zlock',
+        *server,
         '--port',
         config['zlock_port'],
         '-l',
@@ -17,22 +17,49 @@ Script to run a zlog server configured according to LabConfig. Run with:
 
     python -m labscript_utils.zlog [--daemon]
 
-If --daemon is specified, the zlog server will be started in the background.
+If --daemon is specified, the zlog server will be started in the background. If ipc
+is enabled in labconfig, the server is run in a Python process that also listens on
+an ipc:// endpoint, see labscript_utils.ls_zprocess.ipc_endpoint().
 """
 import sys
 import subprocess
-from labscript_utils.ls_zprocess import get_config
+from labscript_utils.ls_zprocess import get_config, ipc_endpoint, _IPCServerMixin
 from labscript_utils.setup_logging import LOG_PATH
 from zprocess import start_daemon
 
 
+def _run_ipc_server():
+    # Run the zprocess zlog server with the remaining command line arguments, using a
+    # subclass of its server class that additionally listens on an ipc:// endpoint:
+    import zprocess.zlog.__main__ as server_main
+
+    i = sys.argv.index('--ipc-server')
+    endpoint = sys.argv[i + 1]
+    del sys.argv[i : i + 2]
+
+    class IPCZMQLogServer(_IPCServerMixin, server_main.ZMQLogServer):
+        ipc_endpoint = endpoint
+
+    server_main.ZMQLogServer = IPCZMQLogServer
+    server_main.main()
+
+
 def main():
+    if '--ipc-server' in sys.argv:
+        _run_ipc_server()
+        return
     config = get_config()
 
+    if config['ipc']:
+        endpoint = ipc_endpoint('zlog', config['zlog_port'])
+        server = ['labscript_utils.zlog', '--ipc-server', endpoint]
+    else:
+        server = ['zprocess.zlog']
+
     cmd = [
         sys.executable,
         '-m',
-        'zprocess.zlog',
+        *server,
         '--port',
         str(config['zlog_port']),
         '--cls',
@@ -0,0 +1,110 @@
+import os
+import copy
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from labscript_utils.connections import ConnectionTable
+import labscript_utils.properties
+import h5py
+
+DTYPE = [
+    ('name', 'S256'),
+    ('class', 'S256'),
+    ('parent', 'S256'),
+    ('parent port', 'S256'),
+    ('unit conversion class', 'S256'),
+    ('unit conversion params', 'S256'),
+    ('BLACS_connection', 'S256'),
+    ('properties', 'S256'),
+]
+
+# name, class, parent, parent port:
+DEVICES = [
+    ('pulseblaster_0', 'PulseBlaster', 'None', 'None'),
+    ('clockline_0', 'ClockLine', 'pulseblaster_0', 'internal'),
+    ('ni_card_0', 'NI_PCIe_6363', 'clockline_0', 'internal'),
+    ('ao_0', 'AnalogOut', 'ni_card_0', 'ao0'),
+    ('ao_1', 'AnalogOut', 'ni_card_0', 'ao1'),
+]
+
+
+class ConnectionTableTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'connection_table.h5')
+        properties = labscript_utils.properties.serialise({'x': [1, 2], 'y': {'z': 3}})
+        rows = [
+            (name, cls, parent, port, 'None', '{}', '', properties)
+            for name, cls, parent, port in DEVICES
+        ]
+        with h5py.File(self.path, 'w') as f:
+            dataset = f.create_dataset('connection table', data=np.array(rows, DTYPE))
+            dataset.attrs['master_pseudoclock'] = 'pulseblaster_0'
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_find_by_name(self):
+        table = ConnectionTable(self.path)
+        for name, _, _, _ in DEVICES:
+            self.assertIs(table.find_by_name(name), table.table[name])
+        self.assertIsNone(table.find_by_name('nonexistent'))
+
+    def test_find_by_name_after_remove_device(self):
+        # A removed device can still be found through its parent's child_list:
+        table = ConnectionTable(self.path)
+        ao_0 = table.find_by_name('ao_0')
+        table.remove_device('ao_0')
+        self.assertNotIn('ao_0', table.table)
+        self.assertIs(table.find_by_name('ao_0'), ao_0)
+
+        # The descendants of a removed top-level device cannot be found:
+        table = ConnectionTable(self.path)
+        table.remove_device('pulseblaster_0')
+        self.assertIsNone(table.find_by_name('pulseblaster_0'))
+        self.assertIsNone(table.find_by_name('ao_1'))
+        self.assertIn('ao_1', table.table)
+
+    def test_find_child_after_remove_device(self):
+        table = ConnectionTable(self.path)
+        self.assertIs(table.find_child('ni_card_0', 'ao0'), table.table['ao_0'])
+        table.remove_device('ao_0')
+        self.assertIsNone(table.find_child('ni_card_0', 'ao0'))
+        self.assertIs(table.find_child('ni_card_0', 'ao1'), table.table['ao_1'])
+
+    def test_pickle_and_deepcopy(self):
+        table = ConnectionTable(self.path)
+        expected = {'x': [1, 2], 'y': {'z': 3}}
+        for roundtrip in [lambda o: pickle.loads(pickle.dumps(o)), copy.deepcopy]:
+            # Before and after the properties have been deserialised:
+            for _ in range(2):
+                connection = roundtrip(table.find_by_name('ao_0'))
+                self.assertEqual(connection.properties, expected)
+                self.assertEqual(connection.unit_conversion_params, {})
+                table.find_by_name('ao_0').properties
+            copied_table = roundtrip(table)
+            self.assertEqual(copied_table.find_by_name('ao_1').properties, expected)
+            copied_table.assert_superset(table)
+
+    def test_pickle_and_deepcopy_with_views(self):
+        table = ConnectionTable(self.path)
+        view = table.find_by_name('ao_0').properties_view
+        self.assertEqual(view['x'], (1, 2))
+        self.assertEqual(view['y']['z'], 3)
+        table.find_by_name('ao_0').unit_conversion_params_view
+        for copied_table in [pickle.loads(pickle.dumps(table)), copy.deepcopy(table)]:
+            connection = copied_table.find_by_name('ao_0')
+            self.assertEqual(dict(connection.properties_view), dict(view))
+
+    def test_set_attribute(self):
+        connection = ConnectionTable(self.path).find_by_name('ao_0')
+        connection.some_attribute = 'some value'
+        self.assertEqual(connection.some_attribute, 'some value')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,302 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from time import monotonic, sleep
+
+import labscript_utils.h5_lock as h5_lock
+from labscript_utils.ls_zprocess import Lock, ProcessTree, ensure_connected_to_zlock
+from labscript_utils.shared_drive import path_to_agnostic
+from labscript_utils.testing_utils import monkeypatch
+import h5py
+
+
+class LockLeaseTestCase(unittest.TestCase):
+    # Short zlock server timeout, such that leases must be renewed:
+    TIMEOUT = 1
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'shot.h5')
+        with h5py.File(self.path, 'w'):
+            pass
+        ensure_connected_to_zlock()
+        self.client = ProcessTree.instance().zlock_client
+        self.default_timeout = self.client.default_timeout
+        self.client.set_default_timeout(self.TIMEOUT)
+
+    def tearDown(self):
+        h5_lock.disable_lock_leases()
+        self.client.set_default_timeout(self.default_timeout)
+        shutil.rmtree(self.tempdir)
+
+    def test_exclusion_with_short_server_timeout(self):
+        h5_lock.enable_lock_leases(grace_period=10)
+        key = path_to_agnostic(self.path)
+        # Intervals during which each thread had the file open or the lock held:
+        ours = []
+        theirs = []
+        stop = threading.Event()
+
+        def other_thread():
+            lock = Lock(key)
+            while not stop.is_set():
+                lock.acquire()
+                start = monotonic()
+                sleep(0.01)
+                theirs.append((start, monotonic()))
+                lock.release()
+                sleep(0.05)
+
+        thread = threading.Thread(target=other_thread, daemon=True)
+        thread.start()
+        deadline = monotonic() + 3 * self.TIMEOUT
+        try:
+            while monotonic() < deadline:
+                with h5py.File(self.path, 'r+'):
+                    start = monotonic()
+                    sleep(0.005)
+                    ours.append((start, monotonic()))
+        finally:
+            stop.set()
+            thread.join()
+
+        # The other thread was not starved, and never had the lock at the same time:
+        self.assertGreater(len(theirs), 1)
+        for our_start, our_end in ours:
+            for their_start, their_end in theirs:
+                self.assertTrue(our_end < their_start or their_end < our_start)
+
+    def test_release_failure_is_logged(self):
+        h5_lock.enable_lock_leases(grace_period=0.2)
+        with self.assertLogs('labscript_utils.h5_lock', 'ERROR'):
+            with h5py.File(self.path, 'r'):
+                # Let the server release the lock:
+                sleep(1.5 * self.TIMEOUT)
+            deadline = monotonic() + 5
+            while h5_lock._leases and monotonic() < deadline:
+                sleep(0.01)
+            # Let the releaser thread log the error:
+            sleep(0.1)
+        self.assertEqual(h5_lock._leases, {})
+        self.assertTrue(h5_lock._lease_releaser_thread.is_alive())
+        with h5py.File(self.path, 'r'):
+            pass
+
+
+class LockStatsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'shot.h5')
+        with h5py.File(self.path, 'w'):
+            pass
+        h5_lock.reset_lock_stats()
+
+    def tearDown(self):
+        h5_lock.disable_lock_stats()
+        h5_lock.reset_lock_stats()
+        shutil.rmtree(self.tempdir)
+
+    def test_histogram(self):
+        histogram = h5_lock.LockTimeHistogram()
+        edges = histogram.BIN_EDGES
+        for duration in [0, 0.01, 0.01, 0.3, 1000]:
+            histogram.add(duration)
+        self.assertEqual(histogram.count, 5)
+        self.assertEqual(histogram.max, 1000)
+        self.assertAlmostEqual(histogram.mean, 1000.32 / 5)
+        self.assertEqual(histogram.counts[0], 1)
+        self.assertEqual(histogram.counts[edges.index(2 ** -6)], 2)
+        self.assertEqual(histogram.counts[edges.index(2 ** -1)], 1)
+        self.assertEqual(histogram.counts[-1], 1)
+        self.assertEqual(sum(histogram.counts), 5)
+        self.assertEqual(histogram.quantile(0.5), 2 ** -6)
+        self.assertEqual(histogram.quantile(1), 1000)
+        self.assertEqual(h5_lock.LockTimeHistogram().quantile(0.5), 0)
+
+    def test_stats(self):
+        h5_lock.enable_lock_stats(log_interval=0, hold_warning_threshold=0.1)
+        with self.assertLogs('labscript_utils.h5_lock', 'INFO') as logs:
+            for _ in range(3):
+                with h5py.File(self.path, 'r'):
+                    pass
+            with h5py.File(self.path, 'r+'):
+                sleep(0.15)
+        h5_lock.disable_lock_stats()
+        with h5py.File(self.path, 'r'):
+            pass
+
+        stats = h5_lock.get_lock_stats(self.path)
+        self.assertEqual(list(h5_lock.get_lock_stats()), [path_to_agnostic(self.path)])
+        self.assertEqual(stats['wait'].count, 4)
+        self.assertEqual(stats['hold'].count, 4)
+        # The slow open is in the bin from 0.125 to 0.25 seconds:
+        edges = h5_lock.LockTimeHistogram.BIN_EDGES
+        self.assertEqual(stats['hold'].counts[edges.index(0.25)], 1)
+        self.assertGreaterEqual(stats['hold'].max, 0.15)
+        self.assertEqual(sum(stats['wait'].counts), 4)
+
+        warnings = [r for r in logs.records if r.levelname == 'WARNING']
+        summaries = [r for r in logs.records if r.levelname == 'INFO']
+        self.assertEqual(len(warnings), 1)
+        self.assertIn('File was opened at', warnings[0].getMessage())
+        self.assertEqual(len(summaries), 4)
+        self.assertIn(path_to_agnostic(self.path), summaries[-1].getMessage())
+
+        empty = h5_lock.get_lock_stats(os.path.join(self.tempdir, 'other.h5'))
+        self.assertEqual(empty['hold'].count, 0)
+        h5_lock.reset_lock_stats()
+        self.assertEqual(h5_lock.get_lock_stats(), {})
+
+
+class LockBatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.paths = [os.path.join(self.tempdir, 'shot_%d.h5' % i) for i in range(2)]
+        for path in self.paths:
+            with h5py.File(path, 'w'):
+                pass
+        ensure_connected_to_zlock()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_batch_past_timeout(self):
+        # Opening a file after the server has released the batch's lock on it takes
+        # the lock again, and releasing the batch does not fail:
+        key = path_to_agnostic(self.paths[1])
+        other_acquired = []
+
+        def other_thread():
+            lock = Lock(key)
+            lock.acquire()
+            other_acquired.append(monotonic())
+            lock.release()
+
+        # The lock on the file not reopened has expired, which is logged:
+        with self.assertLogs('labscript_utils.h5_lock', 'ERROR') as logs:
+            batch = h5_lock.LockBatch(self.paths, read_only=False, timeout=1)
+            with batch:
+                sleep(1.5)
+                with batch.open(self.paths[1]) as f:
+                    thread = threading.Thread(target=other_thread)
+                    thread.start()
+                    sleep(0.5)
+                    f.attrs['written'] = True
+                    closed = monotonic()
+        thread.join()
+        self.assertGreater(other_acquired[0], closed)
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn(path_to_agnostic(self.paths[0]), logs.output[0])
+
+
+class ReadCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tempdir, 'cache')
+        self.path = os.path.join(self.tempdir, 'shot.h5')
+        with h5py.File(self.path, 'w') as f:
+            f.create_group('group')
+
+    def tearDown(self):
+        h5_lock.disable_read_cache()
+        shutil.rmtree(self.tempdir)
+
+    def test_filename(self):
+        h5_lock.enable_read_cache(self.cache_dir)
+        for _ in range(2):
+            with h5py.File(self.path, 'r') as f:
+                with h5py.File(self.path, 'r') as g:
+                    self.assertEqual(g['group'].file.filename, self.path)
+                self.assertEqual(f.filename, self.path)
+                self.assertEqual(f['group'].file.filename, self.path)
+                self.assertNotEqual(f.id.name.decode('utf8'), self.path)
+        self.assertEqual(h5_lock.read_cache_info()['hits'], 3)
+        self.assertEqual(h5_lock._cache_sources, {})
+
+    def test_stale_temp_files_deleted(self):
+        os.makedirs(self.cache_dir)
+        temp_path = os.path.join(self.cache_dir, 'copy.tmp')
+        with open(temp_path, 'w'):
+            pass
+        h5_lock.enable_read_cache(self.cache_dir)
+        # Recent, so possibly being copied by another process:
+        self.assertTrue(os.path.exists(temp_path))
+        with monkeypatch(h5_lock._ReadCache, 'STALE_TEMP_AGE', -1):
+            h5_lock.enable_read_cache(self.cache_dir)
+        self.assertFalse(os.path.exists(temp_path))
+
+
+class StagedWriterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.staging_dir = os.path.join(self.tempdir, 'staging')
+        os.mkdir(self.staging_dir)
+        self.path = os.path.join(self.tempdir, 'shot.h5')
+        with h5py.File(self.path, 'w') as f:
+            f.create_group('images')
+            f.attrs['sequence_index'] = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_commit(self):
+        with h5_lock.StagedWriter(self.path, self.staging_dir) as staging:
+            staging.create_dataset('images/camera', data=[1, 2, 3])
+            staging.attrs['sequence_index'] = 1
+            # Nothing reaches the file until the block exits:
+            with h5py.File(self.path, 'r') as f:
+                self.assertNotIn('camera', f['images'])
+        with h5py.File(self.path, 'r') as f:
+            self.assertEqual(list(f['images/camera'][()]), [1, 2, 3])
+            self.assertEqual(f.attrs['sequence_index'], 1)
+        self.assertEqual(os.listdir(self.staging_dir), [])
+
+    def test_exception(self):
+        with self.assertRaises(RuntimeError):
+            with h5_lock.StagedWriter(self.path, self.staging_dir) as staging:
+                staging.create_dataset('images/camera', data=[1, 2, 3])
+                staging.attrs['sequence_index'] = 1
+                raise RuntimeError('failed')
+        with h5py.File(self.path, 'r') as f:
+            self.assertNotIn('camera', f['images'])
+            self.assertEqual(f.attrs['sequence_index'], 0)
+        self.assertEqual(os.listdir(self.staging_dir), [])
+
+
+class SWMRTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'shot.h5')
+        self.config = dict(h5_lock.get_config(), swmr=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def swmr_enabled(self):
+        return monkeypatch(h5_lock, 'get_config', lambda: self.config)
+
+    def test_reader_bypasses_lock(self):
+        with self.swmr_enabled():
+            with h5py.File(self.path, 'w') as f:
+                self.assertEqual(f.id.get_create_plist().get_version()[0], 3)
+            with h5py.File(self.path, 'r', swmr=True) as f:
+                self.assertFalse(hasattr(f, 'zlock'))
+            with monkeypatch(os, 'environ', dict(HDF5_USE_FILE_LOCKING='FALSE')):
+                with h5py.File(self.path, 'r', swmr=True) as f:
+                    self.assertTrue(hasattr(f, 'zlock'))
+        # Not enabled:
+        with h5py.File(self.path, 'r', swmr=True) as f:
+            self.assertTrue(hasattr(f, 'zlock'))
+
+    def test_old_format_takes_lock(self):
+        with h5py.File(self.path, 'w', libver='earliest'):
+            pass
+        with self.swmr_enabled():
+            with h5py.File(self.path, 'r', swmr=True) as f:
+                self.assertTrue(hasattr(f, 'zlock'))
+
+
+if __name__ == '__main__':
+    unittest.main()
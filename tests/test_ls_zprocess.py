@@ -0,0 +1,352 @@
+import asyncio
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+from time import monotonic, sleep
+
+import zmq
+import zprocess.zlock
+import zprocess.zlock.server
+
+import labscript_utils.ls_zprocess as ls_zprocess
+from labscript_utils.testing_utils import monkeypatch
+
+
+class FcntlLockTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        config = dict(ls_zprocess.get_config(), lock_directory=self.tempdir)
+        self.patch = monkeypatch(ls_zprocess, 'get_config', lambda: config)
+        self.patch.__enter__()
+
+    def tearDown(self):
+        self.patch.__exit__()
+        shutil.rmtree(self.tempdir)
+
+    def test_lock_files_deleted(self):
+        for i in range(10):
+            lock = ls_zprocess.FcntlLock('shot_%d.h5' % i)
+            with lock:
+                self.assertEqual(len(os.listdir(self.tempdir)), 1)
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+        # Not deleted until the last shared lock is released:
+        first = ls_zprocess.FcntlLock('shot.h5', read_only=True)
+        second = ls_zprocess.FcntlLock('shot.h5', read_only=True)
+        first.acquire()
+        thread = threading.Thread(target=second.acquire)
+        thread.start()
+        thread.join()
+        first.release()
+        self.assertEqual(len(os.listdir(self.tempdir)), 1)
+        thread = threading.Thread(target=second.release)
+        thread.start()
+        thread.join()
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+    def test_exclusion(self):
+        # Threads incrementing a counter non-atomically under the lock, whilst lock
+        # files are being deleted and recreated:
+        counter = [0]
+
+        def increment():
+            for _ in range(200):
+                with ls_zprocess.FcntlLock('shot.h5'):
+                    value = counter[0]
+                    sleep(0)
+                    counter[0] = value + 1
+
+        threads = [threading.Thread(target=increment) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(counter[0], 8 * 200)
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+    def test_invalid_reentry(self):
+        lock = ls_zprocess.FcntlLock('shot.h5', read_only=True)
+        with lock:
+            with self.assertRaises(zmq.ZMQError):
+                lock.acquire(read_only=False)
+
+
+class AsyncLockTestCase(unittest.TestCase):
+    def setUp(self):
+        ls_zprocess.ensure_connected_to_zlock()
+
+    def test_cancel_waiting_acquire(self):
+        # Cancelling an acquisition waiting for the lock does not leave the lock held
+        # once it becomes free, whether or not the server has advised retrying yet:
+        for delay in [0.2, 1.5]:
+            with self.subTest(delay=delay):
+                self.assertLess(asyncio.run(self.cancel_waiting_acquire(delay)), 2)
+
+    async def cancel_waiting_acquire(self, delay):
+        key = 'test_cancel_waiting_acquire-%f' % monotonic()
+        loop = asyncio.get_event_loop()
+        holder = ls_zprocess.Lock(key)
+        await loop.run_in_executor(None, holder.acquire)
+        task = asyncio.ensure_future(ls_zprocess.AsyncLock(key).acquire())
+        await asyncio.sleep(delay)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        # Let the cancelled acquisition's cleanup start before the lock is freed:
+        await asyncio.sleep(0.1)
+        await loop.run_in_executor(None, holder.release)
+        other = ls_zprocess.Lock(key)
+        start = monotonic()
+        await loop.run_in_executor(None, other.acquire)
+        elapsed = monotonic() - start
+        await loop.run_in_executor(None, other.release)
+        return elapsed
+
+
+class EchoServer(ls_zprocess.ZMQServer):
+    def handler(self, data):
+        return data
+
+
+class ZMQClientPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = EchoServer(bind_address='tcp://127.0.0.1')
+        self.pool = ls_zprocess.ZMQClientPool()
+        self.pool.IDLE_TIMEOUT = 0.2
+        self.pool.SWEEP_INTERVAL = 0
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+
+    def call(self, data):
+        args = (self.server.port, 'localhost', data)
+        return self.pool.call('get', 'localhost', self.server.port, args, {})
+
+    def sockets(self):
+        return [
+            sender.local.sock
+            for servers in self.pool.servers.values()
+            for senders in servers.values()
+            for sender in senders.senders.values()
+        ]
+
+    def test_singletons(self):
+        # Threads racing to create the singletons all get the same ones:
+        for cls in [ls_zprocess.ZMQClient, ls_zprocess.ZMQClientPool]:
+            instances = []
+            with monkeypatch(cls, '_instance', None):
+                threads = [
+                    threading.Thread(target=lambda: instances.append(cls.instance()))
+                    for _ in range(8)
+                ]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            self.assertEqual(len(instances), 8)
+            self.assertEqual(len(set(map(id, instances))), 1)
+
+    def test_threads_evicted(self):
+        # Sockets of exited threads are closed by a call in another thread:
+        results = []
+        threads = [
+            threading.Thread(target=lambda i=i: results.append(self.call(i)))
+            for i in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results), list(range(4)))
+        sockets = self.sockets()
+        self.assertEqual(len(sockets), 4)
+        self.assertEqual(self.call('main'), 'main')
+        self.assertTrue(all(sock.closed for sock in sockets))
+        self.assertEqual(list(self.pool.servers), [threading.current_thread()])
+
+    def test_idle_evicted(self):
+        # Idle sockets of a live thread are closed by a call in another thread:
+        called = threading.Event()
+        done = threading.Event()
+
+        def idle_thread():
+            self.call('idle')
+            called.set()
+            done.wait()
+
+        thread = threading.Thread(target=idle_thread)
+        thread.start()
+        try:
+            called.wait()
+            [sock] = self.sockets()
+            self.call('main')
+            self.assertFalse(sock.closed)
+            sleep(2 * self.pool.IDLE_TIMEOUT)
+            self.assertEqual(self.call('main'), 'main')
+            self.assertTrue(sock.closed)
+        finally:
+            done.set()
+            thread.join()
+
+
+class SlowEchoServer(EchoServer):
+    def handler(self, data):
+        if data == 'slow':
+            sleep(0.5)
+        return data
+
+
+class AsyncRequestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = SlowEchoServer(bind_address='tcp://127.0.0.1')
+        self.pool = ls_zprocess._AsyncSocketPool()
+
+    def tearDown(self):
+        self.server.shutdown()
+
+    def run_with_pool(self, coro):
+        with monkeypatch(ls_zprocess, '_async_sockets', self.pool):
+            return asyncio.run(coro)
+
+    def idle(self):
+        key = (zmq.REQ, 'localhost', self.server.port, None)
+        return self.pool._sockets(key)
+
+    def get(self, data):
+        return ls_zprocess.zmq_get_async(self.server.port, 'localhost', data)
+
+    def test_round_trip(self):
+        async def requests():
+            return [
+                await self.get({'a': 1}),
+                await ls_zprocess.zmq_get_async(
+                    self.server.port, data=[1, 2], timeout=1
+                ),
+            ]
+
+        self.assertEqual(self.run_with_pool(requests()), [{'a': 1}, [1, 2]])
+
+    def test_reuse(self):
+        async def requests():
+            await self.get(0)
+            [sock] = self.idle()
+            self.assertEqual(await self.get(1), 1)
+            self.assertEqual(self.idle(), [sock])
+            # Concurrent requests each use their own socket, returned to the pool:
+            results = await asyncio.gather(*[self.get(i) for i in range(3)])
+            self.assertEqual(results, [0, 1, 2])
+            self.assertEqual(len(self.idle()), 3)
+            self.assertIn(sock, self.idle())
+
+        self.run_with_pool(requests())
+
+    def test_cancel(self):
+        async def requests():
+            await self.get(0)
+            [sock] = self.idle()
+            task = asyncio.ensure_future(self.get('slow'))
+            await asyncio.sleep(0.1)
+            self.assertEqual(self.idle(), [])
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            # The socket, left waiting for a response, is closed and not reused:
+            self.assertTrue(sock.socket.closed)
+            self.assertEqual(self.idle(), [])
+            self.assertEqual(await self.get(1), 1)
+            [new_sock] = self.idle()
+            self.assertIsNot(new_sock, sock)
+
+        self.run_with_pool(requests())
+
+
+def external_ip():
+    # The address of a non-loopback interface, or None if there isn't one:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect(('192.0.2.1', 9))
+        ip = sock.getsockname()[0]
+    except OSError:
+        return None
+    finally:
+        sock.close()
+    if ls_zprocess.ip_is_loopback(ip):
+        return None
+    return ip
+
+
+class ListLogger(object):
+    def __init__(self):
+        self.warnings = []
+
+    def warning(self, msg):
+        self.warnings.append(msg)
+
+
+class IPCServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        config = dict(ls_zprocess.get_config(), ipc_directory=self.tempdir)
+        self.patch = monkeypatch(ls_zprocess, 'get_config', lambda: config)
+        self.patch.__enter__()
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.stop()
+        self.patch.__exit__()
+        shutil.rmtree(self.tempdir)
+
+    def start_server(self, **kwargs):
+        class IPCLockServer(
+            ls_zprocess._IPCServerMixin, zprocess.zlock.server.ZMQLockServer
+        ):
+            ipc_endpoint = 'ipc://' + os.path.join(self.tempdir, 'zlock.sock')
+
+        self.server = IPCLockServer(silent=True, **kwargs)
+        self.server.run_in_thread()
+        self.server.started.wait()
+        return self.server
+
+    def test_ipc_client(self):
+        server = self.start_server(bind_address='tcp://127.0.0.1')
+        self.assertIsInstance(server.router, ls_zprocess._IPCServerSocket)
+        client = ls_zprocess._IPCZLockClient(server.ipc_endpoint)
+        with client.lock('shot.h5'):
+            pass
+        self.assertGreater(client.ping(), 0)
+
+    def test_insecure_recv_warning(self):
+        ip = external_ip()
+        if ip is None:
+            raise unittest.SkipTest('no external interface')
+        server = self.start_server(
+            bind_address='tcp://0.0.0.0', shared_secret=None, allow_insecure=True
+        )
+        # Binding externally without security requires allow_insecure, so disallow
+        # insecure messages only once bound:
+        server.router.allow_insecure = False
+        server.router.logger = logger = ListLogger()
+        sock = zmq.Context.instance().socket(zmq.REQ)
+        sock.setsockopt(zmq.LINGER, 0)
+        try:
+            sock.connect('tcp://%s:%d' % (ip, server.port))
+            sock.send(b'hello')
+            self.assertEqual(sock.poll(500), 0)
+        finally:
+            sock.close()
+        # The server still responds to local clients:
+        client = zprocess.zlock.ZLockClient('localhost', server.port)
+        self.assertGreater(client.ping(), 0)
+        # One warning per frame discarded:
+        self.assertTrue(logger.warnings)
+        for warning in logger.warnings:
+            self.assertEqual(warning, ls_zprocess.INSECURE_RECV_WARNING % ip)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+from labscript_utils import properties
+
+
+class BinaryEncodingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'shot.h5')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_roundtrip(self):
+        value = {
+            'none': None,
+            'bools': [True, False, np.bool_(True)],
+            'ints': [0, -128, 127, 128, -2 ** 31, 2 ** 31, 2 ** 63 - 1, -2 ** 63],
+            'bigints': [2 ** 63, -2 ** 63 - 1, 10 ** 30],
+            'numpy': [np.int64(7), np.float64(0.5), np.arange(3)],
+            'float': 1.25,
+            'str': 'μs',
+            'bytes': b'\x00\xff',
+            'tuple': (1, 'a'),
+            'nested': {'empty': {}, 'list': [[], [None]]},
+        }
+        expected = dict(
+            value,
+            bools=[True, False, True],
+            numpy=[7, 0.5, [0, 1, 2]],
+            tuple=[1, 'a'],
+        )
+        data = properties.serialise_binary(value)
+        self.assertTrue(properties.is_binary(data))
+        self.assertTrue(properties.is_json(data))
+        self.assertTrue(properties.is_json(np.void(data)))
+        self.assertEqual(properties.deserialise(data), expected)
+        self.assertEqual(properties.deserialise(np.void(data)), expected)
+        self.assertFalse(properties.is_binary(properties.serialise(expected['ints'])))
+
+    def test_invalid(self):
+        data = properties.serialise_binary([1, 2])
+        with self.assertRaises(ValueError):
+            properties.deserialise(data + b'N')
+        with self.assertRaises(ValueError):
+            properties.deserialise(properties.BINARY_IDENTIFIER.encode('utf8') + b'?')
+        with self.assertRaises(TypeError):
+            properties.serialise_binary({1: 2})
+
+    def test_get_many_mixed(self):
+        attributes = {
+            'native': 1.5,
+            'array': np.arange(3),
+            'serialised': {'a': None, 'b': b'\x01'},
+        }
+        with h5py.File(self.path, 'w') as f:
+            for name, binary in [('json_dev', False), ('binary_dev', True)]:
+                group = f.create_group('devices/' + name)
+                properties.set_attributes(group, attributes, binary=binary)
+                properties.set_attributes(group, {'bin': {'raw': b'\x00'}}, binary=True)
+            binary_attr = f['devices/binary_dev'].attrs['serialised']
+            self.assertTrue(properties.is_binary(binary_attr))
+            result = properties.get_many(
+                f, ['json_dev', 'binary_dev'], 'device_properties'
+            )
+        self.assertEqual(set(result), {'json_dev', 'binary_dev'})
+        for name in result:
+            props = result[name]
+            self.assertEqual(set(props), {'native', 'array', 'serialised', 'bin'})
+            self.assertEqual(props['native'], 1.5)
+            np.testing.assert_array_equal(props['array'], np.arange(3))
+            self.assertEqual(props['serialised'], {'a': None, 'b': b'\x01'})
+            self.assertEqual(props['bin'], {'raw': b'\x00'})
+
+
+class AttributeDatasetsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'shot.h5')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_roundtrip(self):
+        array = np.arange(1000.0)
+        with h5py.File(self.path, 'w') as f:
+            group = f.create_group('devices/dev')
+            properties.set_attributes(
+                group, {'arr': array, 'x': 1}, dataset_threshold=1024
+            )
+            self.assertTrue(properties.is_dataset_reference(group.attrs['arr']))
+            np.testing.assert_array_equal(properties.get_attribute(group, 'arr'), array)
+            attributes = properties.get_attributes(group)
+            self.assertIs(type(attributes), dict)
+            self.assertEqual(attributes['x'], 1)
+            np.testing.assert_array_equal(attributes['arr'], array)
+            lazy_attributes = properties.get_attributes(group, lazy=True)
+            self.assertEqual(lazy_attributes['x'], 1)
+        # The dataset is read by reopening the file if first accessed after closing:
+        np.testing.assert_array_equal(lazy_attributes['arr'], array)
+        self.assertEqual(set(lazy_attributes), {'arr', 'x'})
+
+    def test_eager_result_outlives_file(self):
+        array = np.arange(1000.0)
+        with h5py.File(self.path, 'w') as f:
+            group = f.create_group('devices/dev')
+            properties.set_attributes(
+                group, {'arr': array, 'x': 1}, dataset_threshold=1024
+            )
+        with h5py.File(self.path, 'r') as f:
+            attributes = properties.get_attributes(f['devices/dev'], lazy=False)
+        self.assertIs(type(attributes), dict)
+        np.testing.assert_array_equal(attributes['arr'], array)
+        unpickled = pickle.loads(pickle.dumps(attributes))
+        self.assertEqual(set(unpickled), {'arr', 'x'})
+        np.testing.assert_array_equal(unpickled['arr'], array)
+        self.assertEqual(unpickled['x'], 1)
+
+    def test_overwrite_deletes_dataset(self):
+        with h5py.File(self.path, 'w') as f:
+            group = f.create_group('devices/dev')
+            properties.set_attributes(
+                group, {'arr': np.zeros(1000)}, dataset_threshold=1024
+            )
+            datasets = f[properties._attribute_datasets_path(group)]
+            self.assertEqual(len(datasets), 1)
+            properties.set_attributes(group, {'arr': 5})
+            self.assertEqual(len(datasets), 0)
+            self.assertEqual(properties.get_attributes(group), {'arr': 5})
+
+    def test_no_clash_with_child_groups(self):
+        with h5py.File(self.path, 'w') as f:
+            parent = f.create_group('devices/dev')
+            child = parent.create_group('arr')
+            attributes = {'arr': np.ones(1000), '.': np.ones(1000)}
+            for group in [parent, child]:
+                properties.set_attributes(group, attributes, dataset_threshold=1024)
+            for group in [parent, child]:
+                attributes = properties.get_attributes(group)
+                np.testing.assert_array_equal(attributes['arr'], np.ones(1000))
+                np.testing.assert_array_equal(attributes['.'], np.ones(1000))
+
+
+if __name__ == '__main__':
+    unittest.main()